@@ -1 +1,3 @@
 from personate.activators.activators import Activator
+from personate.activators.router import TopicRouter
+from personate.activators.prefilter import LexicalPrefilter, TieredActivation
@@ -12,10 +12,12 @@ from typing import (
     Tuple,
 )
 import discord
-from acrossword import Ranker
+from personate.utils.embeddings import LabelIndex, embeddings_for_turn
+from personate.activators.prefilter import LexicalPrefilter, TieredActivation
 import random
 import asyncio
 import copy
+import time
 from personate.utils.logger import logger
 import inspect
 from inspect import signature, Parameter
@@ -34,6 +36,14 @@ def get_arg_by_name(name: str, args: Tuple[Any], func: Callable) -> Optional[Any
     return None
 
 
+def get_arg_position(name: str, func: Callable) -> Optional[int]:
+    """Like get_arg_by_name, but only does the reflection once: it returns the position of the argument, so you can look it up with a plain index every time the function is called."""
+    for i, param in enumerate(signature(func).parameters.values()):
+        if param.name == name:
+            return i
+    return None
+
+
 class Activator:
     """
     The Activator class comes with handy default configurations for detecting what messages should be passed along to your bot / a Swarm, and which ones should be ignored. It's just syntactic sugar that allows you to dodge "if: if: if:" bullshit, which to me, looks ugly.
@@ -105,6 +115,8 @@ class Activator:
         """This allows you to pass in mandatory checks"""
         self.mandatory_checks = []
         self.optional_checks = []
+        # A moving average of how long each check takes, in seconds, so the cheap ones get asked first.
+        self.costs: Dict[Callable, float] = {}
         self.wrapped_funcs: Dict[str, Dict[str, Dict[str, List[Callable]]]] = {}
         for arg in args:
             if isinstance(arg, Callable) or hasattr(arg, "__call__"):
@@ -169,48 +181,50 @@ class Activator:
         else:
             self.optional_checks.append(checker)
 
+    def by_cost(self, checks: List[Callable]) -> List[Callable]:
+        """Sorts checks from cheapest to most expensive. Checks we haven't timed yet fall back to their estimated_cost, if they have one."""
+        return sorted(
+            checks,
+            key=lambda check: self.costs.get(
+                check, getattr(check, "estimated_cost", 0.0)
+            ),
+        )
+
+    async def timed(self, check: Callable, result: Any) -> bool:
+        start = time.perf_counter()
+        outcome = await check(result)
+        elapsed = time.perf_counter() - start
+        previous = self.costs.get(check)
+        self.costs[check] = (
+            elapsed if previous is None else previous * 0.8 + elapsed * 0.2
+        )
+        return bool(outcome)
+
     async def meets_all_conditions(
         self, func: Callable, result: Any, direction: str
     ) -> bool:
-        async def always_return_true(*args, **kwargs):
-            return True
-
-        ors = [
-            f(result)
-            for f in self.optional_checks
-            + self.wrapped_funcs[func.__name__][direction].get("or", [])
-        ]
-        if len(ors) == 0:
-            meets_or_conditions = True
-        else:
-            meets_or_conditions = any(
-                await asyncio.gather(
-                    *[
-                        f(result)
-                        for f in self.optional_checks
-                        + self.wrapped_funcs[func.__name__][direction].get("or", [])
-                    ]
+        """
+        The mandatory checks go first because any one of them can settle things on its own, then the optional ones. Within each group the cheapest checks are asked first and we stop as soon as the answer is known, so an on_topic check never runs if a ping or a reply has already activated the bot.
+        """
+        wrapped = self.wrapped_funcs[func.__name__].get(direction, {})
+        for check in self.by_cost(self.mandatory_checks + wrapped.get("and", [])):
+            if not await self.timed(check, result):
+                logger.debug(
+                    f"The function: '{func.__name__}'. It failed the 'and' condition {getattr(check, '__name__', check)}, so the conditions were NOT met."
                 )
-            )
-        meets_inbuilt_and_conditions = all(
-            await asyncio.gather(
-                *[
-                    f(result)
-                    for f in self.mandatory_checks
-                    + self.wrapped_funcs[func.__name__][direction].get("and", [])
-                    + [always_return_true]
-                ]
-            )
-        )
-        logger.debug(
-            f"The function: '{func.__name__}'. Does it meet the 'or' conditions? {meets_or_conditions}. Does it meet the 'and' conditions? {meets_inbuilt_and_conditions}"
-        )
-        if meets_or_conditions and meets_inbuilt_and_conditions:
-            logger.debug("I decided that the conditions were met.")
+                return False
+        optional_checks = self.optional_checks + wrapped.get("or", [])
+        if not optional_checks:
+            logger.debug("There are no 'or' conditions, so the conditions were met.")
             return True
-        else:
-            logger.debug("I decided that the conditions were NOT met.")
-            return False
+        for check in self.by_cost(optional_checks):
+            if await self.timed(check, result):
+                logger.debug(
+                    f"The function: '{func.__name__}'. It met the 'or' condition {getattr(check, '__name__', check)}, so the conditions were met."
+                )
+                return True
+        logger.debug("I decided that the conditions were NOT met.")
+        return False
 
     def decorator(
         self,
@@ -251,12 +265,19 @@ class Activator:
             self.wrapped_funcs[func.__name__][applied_to]["and"] = []
             self.wrapped_funcs[func.__name__][applied_to]["or"] = []
 
+        # Work out where the keyword lives in the signature now, so the wrappers below don't have to reflect on every event.
+        position = get_arg_position(keyword, func) if keyword else None
+
+        def select_input(args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+            if keyword in kwargs:
+                return kwargs[keyword]
+            if position is not None and position < len(args):
+                return args[position]
+            return None
+
         async def async_generator_inner(*args, **kwargs) -> Any:
             if apply_to_inputs and (kwargs or args) and keyword:
-                try:
-                    kw = kwargs[keyword]
-                except KeyError:
-                    kw = get_arg_by_name(keyword, args, func)
+                kw = select_input(args, kwargs)
                 if await self.meets_all_conditions(func, kw, applied_to):
                     pass
                 else:
@@ -269,10 +290,7 @@ class Activator:
 
         async def generator_inner(*args, **kwargs) -> Any:
             if apply_to_inputs and (kwargs or args) and keyword:
-                try:
-                    kw = kwargs[keyword]
-                except KeyError:
-                    kw = get_arg_by_name(keyword, args, func)
+                kw = select_input(args, kwargs)
                 if await self.meets_all_conditions(func, kw, applied_to):
                     pass
                 else:
@@ -285,10 +303,7 @@ class Activator:
 
         async def awaitable_inner(*args, **kwargs) -> Any:
             if apply_to_inputs and (kwargs or args) and keyword:
-                try:
-                    kw = kwargs[keyword]
-                except KeyError:
-                    kw = get_arg_by_name(keyword, args, func)
+                kw = select_input(args, kwargs)
                 if await self.meets_all_conditions(func, kw, applied_to):
                     pass
                 else:
@@ -304,10 +319,7 @@ class Activator:
 
         async def sync_inner(*args, **kwargs) -> Any:
             if apply_to_inputs and (kwargs or args) and keyword:
-                try:
-                    kw = kwargs[keyword]
-                except KeyError:
-                    kw = get_arg_by_name(keyword, args, func)
+                kw = select_input(args, kwargs)
                 if await self.meets_all_conditions(func, kw, applied_to):
                     pass
                 else:
@@ -433,7 +445,6 @@ class Activator:
         return checker
 
     def on_topic(self, topic: str, ignore_topics: List[str], **kwargs) -> Callable:
-        ranker = Ranker()
         on_topic = (
             f"This sentence is specifically related to {topic} and mentions {topic}"
         )
@@ -453,16 +464,12 @@ class Activator:
                     for topic in ignore_topics
                 ]
             )
+        index = LabelIndex(topics)
 
         async def checker(msg: discord.Message) -> bool:
             content = msg.content
-            top_topic = await ranker.rank(
-                texts=tuple(topics),
-                query=content,
-                top_k=1,
-                model=ranker.default_model,
-                return_none_if_below_threshold=True,
-                threshold=0.3,
+            top_topic = await index.classify(
+                content, k=1, threshold=0.3, embeddings=embeddings_for_turn(msg.id)
             )
 
             if top_topic:
@@ -472,7 +479,11 @@ class Activator:
                     return False
             return False
 
-        return checker
+        # Most messages can be thrown out without ever touching the embedding model.
+        pipeline = TieredActivation(LexicalPrefilter(topic, ignore_topics), checker)
+        # The TopicRouter reads these to batch this check with every other Agent's.
+        pipeline.topic_labels = topics  # type: ignore
+        return pipeline
 
     def on_diceroll(self, sides: int, **kwargs) -> Callable:
         """
@@ -0,0 +1,136 @@
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+import copy
+import re
+
+import discord
+from personate.utils.logger import logger
+
+logger.disable(__name__)
+
+STOPWORDS = frozenset(
+    """a an and are as at be been but by can could did do does for from had has have he her hers him his
+    how i if im in into is it its it's just like me my no not of oh ok okay on or our out she so than that
+    the their them then there these they this those to too u up us was we were what when where which who
+    why will with would ya yeah yes you your lol lmao haha hahaha xd omg wow hm hmm""".split()
+)
+
+# Custom emojis, mentions, channels and links don't say anything about the topic.
+NOISE = re.compile(r"<a?:\w+:\d+>|<[@#][!&]?\d+>|https?://\S+")
+WORDS = re.compile(r"[^\W\d_][\w']*")
+
+
+def content_words(text: str) -> List[str]:
+    return [
+        word
+        for word in WORDS.findall(NOISE.sub(" ", text.lower()))
+        if len(word) > 1 and word not in STOPWORDS
+    ]
+
+
+class LexicalPrefilter:
+    """
+    The cheap first tier for on_topic checks. It never says yes on its own, it only throws away messages that obviously can't be on topic so that they never reach the embedding model:
+        - messages without a single content word in them ("lol", emoji, "???", links, pings)
+        - messages where every word belongs to one of the ignored topics
+
+    A single content word isn't enough to call a message off topic ("Beethoven?" is about music), so short messages go on to the semantic check by default. If you'd rather trade some of those for fewer embeddings, set min_words: messages with fewer content words than that are thrown away too, unless they mention the topic or something from the vocabulary learned from messages that passed the semantic check.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        ignore_topics: Optional[Iterable[str]] = None,
+        min_words: int = 1,
+        vocabulary_size: int = 2000,
+    ) -> None:
+        self.keywords: Set[str] = set(content_words(topic))
+        self.ignore_keywords: Set[str] = set()
+        for ignored in ignore_topics or []:
+            self.ignore_keywords.update(content_words(ignored))
+        self.ignore_keywords -= self.keywords
+        self.min_words = min_words
+        self.vocabulary_size = vocabulary_size
+        self.vocabulary: Counter = Counter()
+
+    def reject(self, text: str) -> Optional[str]:
+        """Returns the reason for rejecting the text, or None if it should go on to the next tier."""
+        words = content_words(text)
+        if not words:
+            return "no content words"
+        if self.ignore_keywords and all(word in self.ignore_keywords for word in words):
+            return "only ignored topics"
+        if len(words) < self.min_words and not any(
+            word in self.keywords or word in self.vocabulary for word in words
+        ):
+            return "too short"
+        return None
+
+    def learn(self, text: str) -> None:
+        self.vocabulary.update(content_words(text))
+        if len(self.vocabulary) > self.vocabulary_size * 2:
+            self.vocabulary = Counter(
+                dict(self.vocabulary.most_common(self.vocabulary_size))
+            )
+
+
+class TieredActivation:
+    """
+    Runs a message through a LexicalPrefilter and then, only if it survives, through the expensive semantic check (or asks its TopicRouter, once it's been attached to one). It counts how many messages each tier rejects, which is what you'd look at to tune min_words:
+
+        activator.optional_checks[1].stats
+        # {'seen': 1200, 'accepted': 31, 'rejected': {'lexical': 874, 'semantic': 295}}
+    """
+
+    # Until it has been timed, assume this is much slower than a ping or a diceroll.
+    estimated_cost = 0.05
+
+    def __init__(
+        self, prefilter: LexicalPrefilter, semantic: Callable[..., Awaitable[bool]]
+    ) -> None:
+        self.prefilter = prefilter
+        self.semantic = semantic
+        self.seen = 0
+        self.accepted = 0
+        self.rejected: Dict[str, int] = {"lexical": 0, "semantic": 0}
+        self.router = None
+        self.__name__ = getattr(semantic, "__name__", self.__class__.__name__)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "TieredActivation":
+        # A copy (from Activator.copy) isn't attached to the router, and shares the stateless semantic check.
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        for key, value in self.__dict__.items():
+            if key == "router":
+                new.router = None
+            elif key == "semantic":
+                new.semantic = value
+            else:
+                setattr(new, key, copy.deepcopy(value, memo))
+        return new
+
+    async def __call__(self, msg: discord.Message) -> bool:
+        self.seen += 1
+        reason = self.prefilter.reject(msg.content)
+        if reason:
+            self.rejected["lexical"] += 1
+            logger.debug(f"Lexical prefilter rejected {msg.content!r}: {reason}")
+            return False
+        if self.router is not None:
+            fired = await self.router.fires(msg, self)
+        else:
+            fired = await self.semantic(msg)
+        if not fired:
+            self.rejected["semantic"] += 1
+            return False
+        self.accepted += 1
+        self.prefilter.learn(msg.content)
+        return True
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "seen": self.seen,
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+import asyncio
+
+import discord
+import numpy as np
+from personate.utils.embeddings import LabelIndex, embeddings_for_turn
+from personate.utils.logger import logger
+
+logger.disable(__name__)
+
+
+class TopicRouter:
+    """
+    Decides every on_topic check for every Agent sharing a bot in one go. Each on_topic checker carries its own label set (the topic, the neutral sentences and whatever it ignores); the router stacks all of those into one LabelIndex, embeds an incoming message once, scores it against every label with a single matrix-vector product, and then picks each checker's winning label with a masked argmax.
+
+    The first checker to ask about a message pays for the pass, everyone else just reads the result. So a dozen personas on one server cost about the same as one.
+
+    You usually don't need to touch this – Agent.start_all attaches one to every Agent. But you can do it yourself:
+
+        router = TopicRouter()
+        for agent in agents:
+            router.attach(agent.activator)
+    """
+
+    def __init__(self, threshold: float = 0.3, maximum_messages: int = 512) -> None:
+        self.threshold = threshold
+        self.maximum_messages = maximum_messages
+        self.checkers: List[Callable] = []
+        self.index: Optional[LabelIndex] = None
+        self.mask: Optional[np.ndarray] = None
+        self.targets: Optional[np.ndarray] = None
+        self.positions: Dict[Callable, int] = {}
+        self.decisions: "OrderedDict[int, asyncio.Future]" = OrderedDict()
+
+    def attach(self, activator) -> None:
+        """Registers the on_topic checks of an Activator and makes them defer to this router."""
+        for check in activator.optional_checks:
+            if not hasattr(check, "topic_labels"):
+                continue
+            if check not in self.positions:
+                self.positions[check] = len(self.checkers)
+                self.checkers.append(check)
+                self.index = None
+            check.router = self
+
+    def build(self) -> None:
+        labels: List[str] = []
+        columns: Dict[str, int] = {}
+        for check in self.checkers:
+            for label in check.topic_labels:
+                if label not in columns:
+                    columns[label] = len(labels)
+                    labels.append(label)
+        # -inf everywhere a checker doesn't have that label, so the argmax only ever considers its own.
+        mask = np.full((len(self.checkers), len(labels)), -np.inf, dtype=np.float32)
+        targets = np.empty(len(self.checkers), dtype=np.int64)
+        for row, check in enumerate(self.checkers):
+            mask[row, [columns[label] for label in check.topic_labels]] = 0.0
+            targets[row] = columns[check.topic_labels[0]]
+        self.index = LabelIndex(labels)
+        self.mask = mask
+        self.targets = targets
+        self.decisions.clear()
+        logger.debug(
+            f"Built a topic index with {len(labels)} labels for {len(self.checkers)} on_topic checks"
+        )
+
+    async def _decide(self, msg: discord.Message) -> np.ndarray:
+        if self.index is None:
+            self.build()
+        # Hold on to this build, in case someone attaches while we're awaiting the embedding.
+        index, mask, targets = self.index, self.mask, self.targets
+        query_vector = await embeddings_for_turn(msg.id).get(msg.content)
+        scores = (await index.scores(query_vector))[None, :] + mask  # type: ignore
+        winners = scores.argmax(axis=1)
+        best = scores[np.arange(len(winners)), winners]
+        return (winners == targets) & (best >= self.threshold)
+
+    async def fires(self, msg: discord.Message, checker: Callable) -> bool:
+        if checker not in self.positions:
+            raise KeyError("That checker was never attached to this router.")
+        if self.index is None:
+            self.build()
+        decision = self.decisions.get(msg.id)
+        if decision is None:
+            decision = self.decisions[msg.id] = asyncio.ensure_future(
+                self._decide(msg)
+            )
+            while len(self.decisions) > self.maximum_messages:
+                self.decisions.popitem(last=False)
+        try:
+            results = await decision
+        except Exception:
+            self.decisions.pop(msg.id, None)
+            raise
+        if self.positions[checker] >= len(results):
+            # Attached while this message was being decided, so ask again with the new index.
+            self.decisions.pop(msg.id, None)
+            return await self.fires(msg, checker)
+        return bool(results[self.positions[checker]])
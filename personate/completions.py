@@ -1,18 +1,379 @@
-from pyai21 import get
+import abc
+import asyncio
+import hashlib
+import itertools
+import os
+import random
+import re
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence
 
+import aiohttp
+from dotenv import load_dotenv
+from personate.utils.logger import logger
 
-async def default_generator_api(prompt: str) -> str:
+load_dotenv()
+
+# Settings specialised for usage with Agents.
+AGENT_SETTINGS: Dict[str, Any] = dict(
+    stops=[">:", "From Discord", "From IRC", "\n(", "(", "> :", ">", "(Sources"],
+    max_tokens=250,
+    presence_penalty=0.23,
+    temperature=0.865,
+)
+
+# Settings for a Swarm filling in the arguments of a function call.
+SWARM_SETTINGS: Dict[str, Any] = dict(stops=[")\n"], max_tokens=30, temperature=0.55)
+
+
+class CompletionError(Exception):
+    pass
+
+
+class CompletionBackend(abc.ABC):
+    """
+    Something that turns a prompt into completions. Subclasses implement complete(), which returns `n` candidate completions; the rest of personate only talks to this interface, so swapping the model (or replacing it with StubBackend for offline tests and benchmarks) is a one-liner:
+
+        from personate.completions import StubBackend, set_backend
+        set_backend(StubBackend(latency=0.3))
+
+    Calling a backend returns the first completion, so any backend can be used as a Frame's generator_api directly.
+    """
+
+    # Backends that can reuse the computation for a prompt prefix take the key from PrefixRegistry.
+    accepts_prefix_key = True
+
+    @abc.abstractmethod
+    async def complete(
+        self,
+        prompt: str,
+        stops: Sequence[str] = (),
+        max_tokens: int = 250,
+        temperature: float = 0.8,
+        presence_penalty: float = 0.0,
+        n: int = 1,
+        prefix_key: Optional[str] = None,
+    ) -> List[str]:
+        """Returns `n` completions of the prompt, each cut at the first of `stops`."""
+
+    async def close(self) -> None:
+        pass
+
+    async def __call__(self, prompt: str, **kwargs) -> str:
+        return (await self.complete(prompt, **kwargs))[0]
+
+    async def candidates(self, prompt: str, n: int, **kwargs) -> List[str]:
+        return await self.complete(prompt, n=n, **kwargs)
+
+    async def stream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """Yields the completion a chunk at a time. Backends whose API can't stream (AI21's can't) yield the whole completion as one chunk, so callers don't have to care."""
+        yield (await self.complete(prompt, **kwargs))[0]
+
+
+class AI21Backend(CompletionBackend):
+    """
+    Talks to AI21 Studio directly over one pooled aiohttp session, instead of opening a connection per request.
+        keys: API keys to rotate through. Defaults to the file named by AI21_API_KEY_FILE (one key per line) or AI21_API_KEY.
+        concurrency: how many requests can be in flight at once, across everything sharing this backend.
+        timeout: seconds before a single request is given up on.
+        retries: how many more times to try after a timeout, a connection error, a 429 or a 5xx, with exponential backoff. Anything else fails straight away.
+    """
+
+    url = "https://api.ai21.com/studio/v1/{model}/complete"
+
+    def __init__(
+        self,
+        model: str = "j1-jumbo",
+        keys: Optional[Sequence[str]] = None,
+        concurrency: int = 4,
+        timeout: float = 30,
+        retries: int = 2,
+    ) -> None:
+        if keys is None:
+            keys = self.keys_from_environment()
+        if not keys:
+            raise CompletionError("No AI21 key found: set AI21_API_KEY_FILE or AI21_API_KEY in .env")
+        self.model = model
+        self.keys = itertools.cycle(list(keys))
+        self.key = next(self.keys)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.requests = 0
+        self.failures = 0
+
+    @staticmethod
+    def keys_from_environment() -> List[str]:
+        key_file = os.getenv("AI21_API_KEY_FILE")
+        if key_file and os.path.exists(key_file):
+            with open(key_file) as f:
+                return [line.strip() for line in f if line.strip()]
+        key = os.getenv("AI21_API_KEY")
+        return [key] if key else []
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        # Agent.run starts a fresh event loop after a timeout, and sessions can't move between loops.
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            if self.session is not None and not self.session.closed:
+                # Agents close their backends before their loop ends (see Agent.close_backends), so this is only
+                # for sessions left behind some other way. Its connections died with its loop, but the session
+                # still needs closing, or it's reported as unclosed.
+                await self.session.close()
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.loop = loop
+        return self.session
+
+    async def complete(
+        self,
+        prompt: str,
+        stops: Sequence[str] = (),
+        max_tokens: int = 250,
+        temperature: float = 0.8,
+        presence_penalty: float = 0.0,
+        n: int = 1,
+        prefix_key: Optional[str] = None,
+    ) -> List[str]:
+        payload = {
+            "prompt": prompt,
+            "numResults": n,
+            "maxTokens": max_tokens,
+            "temperature": temperature,
+            "stopSequences": list(stops),
+            "presencePenalty": {"scale": presence_penalty},
+        }
+        session = await self.get_session()
+        async with self.semaphore:  # type: ignore
+            for attempt in range(self.retries + 1):
+                self.requests += 1
+                try:
+                    async with session.post(
+                        self.url.format(model=self.model),
+                        json=payload,
+                        headers={"Authorization": f"Bearer {self.key}"},
+                    ) as response:
+                        if response.status == 200:
+                            data = await response.json()
+                            return [c["data"]["text"] for c in data["completions"]]
+                        if response.status == 429:
+                            # This key has run out, try the next one.
+                            self.key = next(self.keys)
+                        elif response.status < 500:
+                            raise CompletionError(
+                                f"AI21 returned {response.status}: {await response.text()}"
+                            )
+                        error: Exception = CompletionError(f"AI21 returned {response.status}")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                self.failures += 1
+                logger.warning(f"Completion attempt {attempt + 1} failed: {error!r}")
+                if attempt < self.retries:
+                    await asyncio.sleep(0.5 * 2**attempt + random.random() * 0.25)
+            raise CompletionError("AI21 completion failed") from error
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class PyAI21Backend(CompletionBackend):
+    """Goes through pyai21, which is what personate always used. This is the fallback when there's no AI21 key, since pyai21 also knows how to talk to The Pool (POOL_KEY)."""
+
+    async def complete(
+        self,
+        prompt: str,
+        stops: Sequence[str] = (),
+        max_tokens: int = 250,
+        temperature: float = 0.8,
+        presence_penalty: float = 0.0,
+        n: int = 1,
+        prefix_key: Optional[str] = None,
+    ) -> List[str]:
+        from pyai21 import get
+
+        kwargs: Dict[str, Any] = dict(
+            prompt=prompt, stops=list(stops), max=max_tokens, temp=temperature
+        )
+        if presence_penalty:
+            kwargs["presence_penalty"] = presence_penalty
+        results = await asyncio.gather(*[get(**kwargs) for _ in range(n)])
+        return [result[0] if isinstance(result, list) else result for result in results]
+
+
+class StubBackend(CompletionBackend):
+    """
+    A local, deterministic stand-in for a real model: the same prompt always gets the same completions, built from `responses` (or random-ish words if you don't give any) and cut at the first stop sequence. With `latency` it sleeps like a real request would, so you can benchmark the whole reply pipeline offline.
+    """
+
+    words = (
+        "yeah that sounds about right honestly I think the real question is whether anyone "
+        "actually cares about it though maybe we should try again tomorrow and see what happens"
+    ).split()
+
+    def __init__(
+        self,
+        responses: Optional[Sequence[str]] = None,
+        latency: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.responses = list(responses) if responses else None
+        self.latency = latency
+        self.seed = seed
+        self.calls: List[Dict[str, Any]] = []
+
+    def generate(self, prompt: str, index: int, max_tokens: int) -> str:
+        digest = hashlib.blake2b(f"{self.seed}:{index}:{prompt}".encode(), digest_size=8)
+        rng = random.Random(digest.digest())
+        if self.responses:
+            return rng.choice(self.responses)
+        return " " + " ".join(rng.choice(self.words) for _ in range(rng.randint(4, min(24, max_tokens))))
+
+    async def stream(
+        self,
+        prompt: str,
+        stops: Sequence[str] = (),
+        max_tokens: int = 250,
+        prefix_key: Optional[str] = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """Yields the same completion complete() would give, a word at a time, spreading `latency` out over the words."""
+        self.calls.append({"prompt": prompt, "n": 1, "prefix_key": prefix_key, "stream": True})
+        chunks = re.findall(r"\s*\S+", self.generate(prompt, 0, max_tokens))
+        for chunk in chunks:
+            if self.latency:
+                await asyncio.sleep(self.latency / len(chunks))
+            yield chunk
+
+    async def complete(
+        self,
+        prompt: str,
+        stops: Sequence[str] = (),
+        max_tokens: int = 250,
+        temperature: float = 0.8,
+        presence_penalty: float = 0.0,
+        n: int = 1,
+        prefix_key: Optional[str] = None,
+    ) -> List[str]:
+        self.calls.append({"prompt": prompt, "n": n, "prefix_key": prefix_key})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        completions = []
+        for index in range(n):
+            text = self.generate(prompt, index, max_tokens)
+            for stop in stops:
+                if stop in text:
+                    text = text[: text.index(stop)]
+            completions.append(text)
+        return completions
+
+
+def backend_from_dict(data: Dict[str, Any]) -> CompletionBackend:
+    """Builds a backend from the "completion_backend" section of an Agent's JSON, e.g. {"type": "ai21", "model": "j1-large", "concurrency": 8}."""
+    options = dict(data)
+    kind = options.pop("type", "ai21")
+    if kind == "ai21":
+        return AI21Backend(**options)
+    if kind == "pyai21":
+        return PyAI21Backend()
+    if kind == "stub":
+        return StubBackend(**options)
+    raise ValueError(f"Unknown completion backend {kind!r}")
+
+
+_backend: Optional[CompletionBackend] = None
+
+
+def get_backend() -> CompletionBackend:
+    """Returns the shared CompletionBackend. Unless one was set, that's AI21Backend if there's an AI21 key in the environment and PyAI21Backend otherwise."""
+    global _backend
+    if _backend is None:
+        if AI21Backend.keys_from_environment():
+            _backend = AI21Backend()
+        else:
+            _backend = PyAI21Backend()
+    return _backend
+
+
+def set_backend(backend: CompletionBackend) -> CompletionBackend:
+    global _backend
+    _backend = backend
+    return backend
+
+
+async def close_backend() -> None:
+    """Closes the shared backend's connections, if it has been created. It opens new ones the next time it's used."""
+    if _backend is not None:
+        await _backend.close()
+
+
+async def default_generator_api(prompt: str, **kwargs) -> str:
     """This function returns the text of a prompt according to settings specialised for usage with Agents.
     :param prompt: The prompt to get the text of.
     :return: The text of the prompt."""
-    res = await get(
-        prompt=prompt,
-        stops=[">:", "From Discord", "From IRC", "\n(", "(", "> :", ">", "(Sources"],
-        max=250,
-        presence_penalty=0.23,
-        temp=0.865,
-    )
-    if isinstance(res, list):
-        return res[0]
-    else:
-        return res
+    return (await get_backend().complete(prompt, **{**AGENT_SETTINGS, **kwargs}))[0]
+
+
+async def stop_at_stops(chunks: AsyncIterator[str], stops: Sequence[str]) -> AsyncIterator[str]:
+    """Passes chunks through until the text contains a stop sequence, then yields whatever came before it and stops. A stop can be split across chunks, so only text that can't be the start of one is let through early."""
+    held = ""
+    longest = max((len(stop) for stop in stops), default=1)
+    try:
+        async for chunk in chunks:
+            held += chunk
+            cut = min((held.index(stop) for stop in stops if stop in held), default=None)
+            if cut is not None:
+                if held[:cut]:
+                    yield held[:cut]
+                return
+            safe = len(held) - (longest - 1)
+            if safe > 0:
+                yield held[:safe]
+                held = held[safe:]
+        if held:
+            yield held
+    finally:
+        # Closing the stream early cancels the request, rather than leaving it to finish in the background.
+        await chunks.aclose()  # type: ignore
+
+
+def default_stream_api(prompt: str, **kwargs) -> AsyncIterator[str]:
+    """Like default_generator_api, but yields the completion in chunks as it's generated, ending at the first stop sequence."""
+    settings = {**AGENT_SETTINGS, **kwargs}
+    return stop_at_stops(get_backend().stream(prompt, **settings), settings["stops"])
+
+
+async def default_candidates_api(prompt: str, n: int, **kwargs) -> List[str]:
+    """Like default_generator_api, but asks for n completions in one request."""
+    return await get_backend().complete(prompt, **{**AGENT_SETTINGS, **kwargs, "n": n})
+
+
+def generator_api_for(backend: CompletionBackend) -> Callable:
+    """A generator api like default_generator_api, with candidates and stream, but always using this backend instead of the shared one. This is how a single Agent gets its own backend (see AgentFrame.set_completion_backend)."""
+
+    async def generator_api(prompt: str, **kwargs) -> str:
+        return (await backend.complete(prompt, **{**AGENT_SETTINGS, **kwargs}))[0]
+
+    async def candidates(prompt: str, n: int, **kwargs) -> List[str]:
+        return await backend.complete(prompt, **{**AGENT_SETTINGS, **kwargs, "n": n})
+
+    def stream(prompt: str, **kwargs) -> AsyncIterator[str]:
+        settings = {**AGENT_SETTINGS, **kwargs}
+        return stop_at_stops(backend.stream(prompt, **settings), settings["stops"])
+
+    generator_api.accepts_prefix_key = True  # type: ignore
+    generator_api.candidates = candidates  # type: ignore
+    generator_api.stream = stream  # type: ignore
+    generator_api.backend = backend  # type: ignore
+    return generator_api
+
+
+default_generator_api.accepts_prefix_key = True  # type: ignore
+default_generator_api.candidates = default_candidates_api  # type: ignore
+default_generator_api.stream = default_stream_api  # type: ignore
@@ -13,46 +13,155 @@ from typing import (
 )
 import inspect
 import asyncio
-from rapidfuzz import fuzz, process
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import functools
+import itertools
+from collections import OrderedDict
+from personate.decos.repetition import RepetitionIndex
+from personate.decos.slur_matcher import SlurMatcher, get_slur_matcher, inbuilt_slur_entries
 from personate.utils.logger import logger
 
 
+_filter_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_filter_executor() -> ThreadPoolExecutor:
+    """The executor cpu_bound conditions run in. It's separate from the default executor (which the database and the embedding model also use) and has a fixed number of workers, so a burst of replies can't starve anything else."""
+    global _filter_executor
+    if _filter_executor is None:
+        _filter_executor = ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="personate-filters"
+        )
+    return _filter_executor
+
+
 class Condition(ABC):
-    def __init__(self, condition: Callable) -> None:
+    """
+    Wraps a function that returns True when a response should be rejected. Coroutine functions are awaited, plain functions are called inline (they're almost always a substring check or a set lookup, so a trip through a thread pool costs more than the check), and plain functions marked cpu_bound run in get_filter_executor() so that they don't block the event loop.
+
+    Every call is timed: see stats().
+    """
+
+    def __init__(self, condition: Callable, cpu_bound: bool = False) -> None:
         self.condition = condition
+        self.cpu_bound = cpu_bound
+        self.is_coroutine = inspect.iscoroutinefunction(condition)
+        self.calls = 0
+        self.rejections = 0
+        self.total_time = 0.0
+
+    @property
+    def inline(self) -> bool:
+        return not self.is_coroutine and not self.cpu_bound
+
+    @property
+    def cost(self) -> float:
+        """Mean seconds per call so far."""
+        return self.total_time / self.calls if self.calls else 0.0
 
     async def validate(self, *args, **kwargs) -> bool:
-        loop = asyncio.get_event_loop()
-        if inspect.iscoroutinefunction(self.condition):
-            return await self.condition(*args, **kwargs)
-        else:
-            return await loop.run_in_executor(
-                None, functools.partial(self.condition, *args, **kwargs)
+        started = time.perf_counter()
+        if self.is_coroutine:
+            result = await self.condition(*args, **kwargs)
+        elif self.cpu_bound:
+            result = await asyncio.get_running_loop().run_in_executor(
+                get_filter_executor(), functools.partial(self.condition, *args, **kwargs)
             )
+        else:
+            result = self.condition(*args, **kwargs)
+        self.calls += 1
+        self.rejections += bool(result)
+        self.total_time += time.perf_counter() - started
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "rejections": self.rejections,
+            "mean_seconds": self.cost,
+        }
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.condition.__name__})"
 
 
 class Filter(ABC):
+    """
+    Rejects a response (validate returns True) if any of its conditions do. Inline conditions run first, one after the other; the rest (coroutines, cpu_bound conditions and nested Filters) run concurrently, cheapest first, and as soon as one of them rejects, the others are cancelled.
+
+    Anything with an async validate() works as a condition. If it doesn't say whether it's inline, it's awaited in the first, one-at-a-time pass, and bare functions are wrapped in a Condition.
+    """
+
+    inline = False
+
     def __init__(self, filters: List[Union["Filter", "Condition"]], **kwargs) -> None:
-        self.conditions: List[Union[Condition, Filter]] = filters
+        self.conditions: List[Union[Condition, Filter]] = [
+            self.as_condition(condition) for condition in filters
+        ]
+
+    @staticmethod
+    def as_condition(condition: Any) -> Any:
+        if not hasattr(condition, "validate") and callable(condition):
+            return Condition(condition)
+        return condition
 
     def __repr__(self) -> str:
         return f"<Filter {self.conditions}>"
 
+    @property
+    def cost(self) -> float:
+        return sum(getattr(condition, "cost", 0.0) for condition in self.conditions)
+
     async def validate(self, *args, **kwargs) -> bool:
-        bools = [
-            await condition.validate(*args, **kwargs) for condition in self.conditions
-        ]
-        names = [condition for condition in self.conditions]
-        bools_and_names = "\n".join(
-            f"{name}: {bool_}" for name, bool_ in zip(names, bools)
+        concurrent = []
+        for condition in self.conditions:
+            if not getattr(condition, "inline", True):
+                concurrent.append(condition)
+            elif await condition.validate(*args, **kwargs):
+                logger.debug(f"{self} rejected the response: {condition}")
+                return True
+        if not concurrent:
+            return False
+        concurrent.sort(key=lambda condition: getattr(condition, "cost", 0.0))
+        if len(concurrent) == 1:
+            rejected = await concurrent[0].validate(*args, **kwargs)
+            if rejected:
+                logger.debug(f"{self} rejected the response: {concurrent[0]}")
+            return rejected
+        tasks = {
+            asyncio.ensure_future(condition.validate(*args, **kwargs)): condition
+            for condition in concurrent
+        }
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        logger.debug(f"{self} rejected the response: {tasks[task]}")
+                        return True
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def validate_partial(self, text: str) -> bool:
+        """Checks a completion that's still being streamed, and returns True if it can already be rejected, whatever comes after. Only Filters that can tell from a prefix (like SlurFilter) override this; the rest wait for the whole completion."""
+        return any(
+            condition.validate_partial(text)
+            for condition in self.conditions
+            if isinstance(condition, Filter)
         )
-        logger.debug(f"{self} produced the following results: {bools_and_names}")
 
-        return any(bools)
+    def stats(self) -> Dict[str, Any]:
+        """The cost of every condition in this Filter (and the Filters inside it), keyed by their repr."""
+        return {
+            repr(condition): condition.stats()
+            for condition in self.conditions
+            if hasattr(condition, "stats")
+        }
 
     @classmethod
     def redo(cls, redos: int = 3, **kwargs) -> Callable:
@@ -65,8 +174,8 @@ class Filter(ABC):
                         res = await func(*args, **kwargs)
                         if await instance.validate(res):
                             return res
-                    except Exception as e:
-                        print(f"{e}")
+                    except Exception:
+                        logger.exception(f"{func.__name__} failed, trying again")
                 return await func(*args, **kwargs)
 
             return inner_wrapper
@@ -74,59 +183,86 @@ class Filter(ABC):
         return wrapper
 
     def add_condition(self, condition: Union[Condition, "Filter"]) -> None:
-        self.conditions.append(condition)
+        self.conditions.append(self.as_condition(condition))
 
 
 class DeviatesFromScriptFilter(Filter):
     def __init__(self, required_formatting: str = "\n<") -> None:
-        async def does_not_contain_formatting(response: str, **kwargs) -> bool:
+        def does_not_contain_formatting(response: str, **kwargs) -> bool:
             return required_formatting not in response
 
         DeviatesFromScriptCondition = Condition(does_not_contain_formatting)
         super().__init__([DeviatesFromScriptCondition])
 
 
-async def too_similar(threshold: int, response: str, final_prompt: str) -> bool:
+def too_similar(index: RepetitionIndex, threshold: int, response: str, **kwargs) -> bool:
     response = response.split("\n<")[0]
-    return fuzz.partial_token_sort_ratio(response, final_prompt) >= threshold  # type: ignore
+    score, line = index.similarity(response)
+    if score * 100 >= threshold:
+        logger.debug(f"{response!r} repeats {line!r} ({score:.0%})")
+        return True
+    return False
 
 
 class TooSimilarFilter(Filter):
-    def __init__(self, threshold: int = 68) -> None:
+    """
+    Rejects responses that repeat a line that's already in the prompt, like one of the agent's own earlier turns. The prompt is indexed by word n-grams (see RepetitionIndex) the first time a response is checked against it, and every other candidate for the same prompt reuses the index. threshold is the percentage of a response's n-grams that one line has to contain.
+    """
+
+    def __init__(self, threshold: int = 68, shingle_size: int = 3, maximum_prompts: int = 8) -> None:
         self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.maximum_prompts = maximum_prompts
+        self.indexes: "OrderedDict[str, RepetitionIndex]" = OrderedDict()
         super().__init__([Condition(too_similar)])
 
+    def index_for(self, final_prompt: str) -> RepetitionIndex:
+        index = self.indexes.get(final_prompt)
+        if index is None:
+            index = self.indexes[final_prompt] = RepetitionIndex(final_prompt, self.shingle_size)
+            while len(self.indexes) > self.maximum_prompts:
+                self.indexes.popitem(last=False)
+        return index
+
     async def validate(self, response: str, final_prompt: str, **kwargs) -> bool:
         return await super().validate(
-            response=response, final_prompt=final_prompt, threshold=self.threshold
+            response=response, index=self.index_for(final_prompt), threshold=self.threshold
         )
 
 
 # from decos.slurslist import slurs
-async def contains_slurs(slurs: Set[str], response: str, **kwargs) -> bool:
-    words = set(response.lower().split())
-    common_words = words.intersection(slurs)
-    return len(common_words) > 0
+def contains_slurs(matcher: SlurMatcher, response: str, **kwargs) -> bool:
+    return matcher.contains(response)
 
 
 class SlurFilter(Filter):
-    def __init__(self, slurs: Optional[List[str]] = None) -> None:
-        if not slurs:
-            slurs = get_inbuilt_slurs()
-        self.slurs = set(slurs)
+    """
+    Rejects responses containing anything from the slur list, including phrases, words with punctuation stuck to them and leetspeak spellings. Pass your own list as `slurs`, or pick how severe an inbuilt entry has to be with `minimum` ("Mild", "Strong" or "Severe") and `minimum_rating`.
+    """
+
+    def __init__(
+        self,
+        slurs: Optional[List[str]] = None,
+        minimum: str = "Strong",
+        minimum_rating: Optional[float] = None,
+    ) -> None:
+        if slurs:
+            self.slurs = set(slurs)
+            self.matcher = SlurMatcher.from_words(self.slurs)
+        else:
+            self.matcher = get_slur_matcher(minimum, minimum_rating)
+            self.slurs = {entry.text for _, _, entry in itertools.chain(*self.matcher.index.values())}
         super().__init__([Condition(contains_slurs)])
 
     async def validate(self, response: str, **kwargs) -> bool:
-        return await super().validate(response=response, slurs=self.slurs)
-
+        return await super().validate(response=response, matcher=self.matcher)
 
-import csv
+    def validate_partial(self, text: str) -> bool:
+        return self.matcher.contains(text)
 
 
 def get_inbuilt_slurs() -> List[str]:
-    slurs: str = __import__("personate.decos.slurs", fromlist=["slurs"]).slurs
-    reader = csv.reader(slurs.splitlines())
-    return [row[0] for row in reader if not "Mild" in row[-1]]
+    return [entry.text for entry in inbuilt_slur_entries() if entry.severity != "Mild"]
 
 
 class DefaultFilter(Filter):
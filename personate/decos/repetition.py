@@ -0,0 +1,58 @@
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+import re
+
+WORDS = re.compile(r"\w+")
+# The "<name>: " at the start of a line of conversation or of an example.
+SPEAKER = re.compile(r"^\s*<[^>]*>\s*:?")
+
+Shingle = Tuple[str, ...]
+
+
+def words_of(text: str) -> Tuple[str, ...]:
+    return tuple(WORDS.findall(text.lower()))
+
+
+def shingles_of(words: Tuple[str, ...], size: int) -> Set[Shingle]:
+    if len(words) < size:
+        return set()
+    return {words[i : i + size] for i in range(len(words) - size + 1)}
+
+
+class RepetitionIndex:
+    """
+    An index of every line of a prompt (the introduction, the examples and the conversation so far, including the agent's own earlier turns) by its word n-grams. It's built once per prompt; after that, checking a candidate response only looks at the n-grams of the response, however long the prompt is.
+
+    similarity() is the largest fraction of the response's n-grams found in any single line, so a response that repeats an earlier line (or most of one) scores close to 1 even if it's padded out a little. Responses shorter than n words are only caught if they repeat a whole line word for word.
+    """
+
+    def __init__(self, prompt: str, size: int = 3) -> None:
+        self.size = size
+        self.lines: List[str] = []
+        self.whole_lines: Set[Tuple[str, ...]] = set()
+        self.postings: Dict[Shingle, List[int]] = {}
+        for line in prompt.splitlines():
+            words = words_of(SPEAKER.sub("", line))
+            if not words:
+                continue
+            line_id = len(self.lines)
+            self.lines.append(line)
+            self.whole_lines.add(words)
+            for shingle in shingles_of(words, size):
+                self.postings.setdefault(shingle, []).append(line_id)
+
+    def similarity(self, response: str) -> Tuple[float, Optional[str]]:
+        """Returns the score (0 to 1) and the line it came from."""
+        words = words_of(SPEAKER.sub("", response))
+        if not words:
+            return 0.0, None
+        shingles = shingles_of(words, self.size)
+        if not shingles:
+            return (1.0, " ".join(words)) if words in self.whole_lines else (0.0, None)
+        hits: Counter = Counter()
+        for shingle in shingles:
+            hits.update(self.postings.get(shingle, ()))
+        if not hits:
+            return 0.0, None
+        line_id, count = hits.most_common(1)[0]
+        return count / len(shingles), self.lines[line_id]
@@ -0,0 +1,149 @@
+import csv
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+SEVERITIES = {"Mild": 1, "Strong": 2, "Severe": 3}
+
+# Separators between words. Hyphens and underscores count, so "arse-hole" and "a_s_s" are several words,
+# exactly like the entries in the list that are written that way.
+SEPARATORS = re.compile(r"[\s\-_/\\,;:?\"()\[\]{}<>~|]+")
+# Punctuation that gets stuck to the ends of words ("bitch!", "'shit'") rather than standing in for a letter.
+EDGE_PUNCTUATION = "!.?'\"*`"
+LEETSPEAK = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s", "!": "i", "+": "t"})
+LEET_CHARACTERS = re.compile(r"[013457@$!+]")
+NOT_ALPHANUMERIC = re.compile(r"[^a-z0-9]")
+# Everything NOT_ALPHANUMERIC would remove from a word, except the separators.
+STRAY_CHARACTERS = re.compile(r"[^a-z0-9\s\-_/\\,;:?\"()\[\]{}<>~|]")
+
+
+def split_words(text: str) -> List[Tuple[str, bool]]:
+    """
+    Splits text into lowercased words with leetspeak undone and stray punctuation removed. The slur list goes through this too, so both sides always agree on what a word is.
+
+    Each word comes with whether undoing leetspeak changed it. Entries that only exist as leetspeak ("n1g3r", "f0cker") only match words that were written in leetspeak too, so the country and the surname they'd otherwise collide with are left alone.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    if not LEET_CHARACTERS.search(text):
+        # Nearly every response, and this way it's two regex passes over the whole text instead of two per word.
+        return [(word, False) for word in SEPARATORS.split(STRAY_CHARACTERS.sub("", text)) if word]
+    words = []
+    for word in SEPARATORS.split(text):
+        word = word.strip(EDGE_PUNCTUATION)
+        plain = NOT_ALPHANUMERIC.sub("", word)
+        if LEET_CHARACTERS.search(word):
+            unleeted = NOT_ALPHANUMERIC.sub("", word.translate(LEETSPEAK))
+            if unleeted:
+                words.append((unleeted, unleeted != plain))
+        elif plain:
+            words.append((plain, False))
+    return words
+
+
+def normalise(text: str) -> List[str]:
+    return [word for word, _ in split_words(text)]
+
+
+class SlurEntry(NamedTuple):
+    text: str
+    canonical_forms: Tuple[str, ...]
+    rating: float
+    severity: str
+
+
+class SlurMatch(NamedTuple):
+    entry: SlurEntry
+    position: int
+    matched: str
+
+
+class SlurMatcher:
+    """
+    Finds every entry of a slur list in a piece of text in one pass over its words. Entries are indexed by their first (normalised) word, so each word of the text costs a single dict lookup, plus a short walk for the few entries that are phrases ("anal hole", "0ral sex"). Matches always start and end on word boundaries, so "class" doesn't match "ass".
+
+    Build it once and reuse it: get_slur_matcher() keeps one per severity threshold.
+
+        matcher = get_slur_matcher(minimum="Strong")
+        matcher.find("you absolute @sshole!")
+        # [SlurMatch(entry=SlurEntry(text='@sshole', canonical_forms=('ass',), rating=1.6, severity='Strong'), position=2, matched='asshole')]
+    """
+
+    def __init__(self, entries: Iterable[SlurEntry]) -> None:
+        # first word -> [(all the words, whether it only matches leetspeak, entry)]
+        self.index: Dict[str, List[Tuple[Tuple[str, ...], bool, SlurEntry]]] = {}
+        self.size = 0
+        for entry in entries:
+            split = split_words(entry.text)
+            if not split:
+                continue
+            words = tuple(word for word, _ in split)
+            leet_only = any(altered for _, altered in split)
+            self.index.setdefault(words[0], []).append((words, leet_only, entry))
+            self.size += 1
+        # Longest phrases first, so the most specific entry is the one that's reported.
+        for candidates in self.index.values():
+            candidates.sort(key=lambda candidate: -len(candidate[0]))
+
+    @classmethod
+    def from_words(cls, words: Iterable[str]) -> "SlurMatcher":
+        return cls(SlurEntry(word, (word,), 0.0, "") for word in words)
+
+    def _scan(self, split: List[Tuple[str, bool]]):
+        index = self.index
+        words = [word for word, _ in split]
+        for position, word in enumerate(words):
+            candidates = index.get(word)
+            if candidates is None:
+                continue
+            for phrase, leet_only, entry in candidates:
+                end = position + len(phrase)
+                if len(phrase) > 1 and tuple(words[position:end]) != phrase:
+                    continue
+                if leet_only and not any(altered for _, altered in split[position:end]):
+                    continue
+                yield SlurMatch(entry, position, " ".join(phrase))
+                break
+
+    def find(self, text: str) -> List[SlurMatch]:
+        return list(self._scan(split_words(text)))
+
+    def contains(self, text: str) -> bool:
+        split = split_words(text)
+        if self.index.keys().isdisjoint(word for word, _ in split):
+            return False
+        return next(self._scan(split), None) is not None
+
+
+def read_slur_entries() -> List[SlurEntry]:
+    slurs: str = __import__("personate.decos.slurs", fromlist=["slurs"]).slurs
+    reader = csv.reader(slurs.splitlines())
+    next(reader)
+    return [
+        SlurEntry(
+            text=row[0],
+            canonical_forms=tuple(form for form in row[1:4] if form),
+            rating=float(row[7]),
+            severity=row[8],
+        )
+        for row in reader
+    ]
+
+
+@lru_cache(maxsize=None)
+def inbuilt_slur_entries() -> Tuple[SlurEntry, ...]:
+    return tuple(read_slur_entries())
+
+
+@lru_cache(maxsize=None)
+def get_slur_matcher(
+    minimum: str = "Strong", minimum_rating: Optional[float] = None
+) -> SlurMatcher:
+    """The matcher for the inbuilt list, keeping entries at or above a severity ("Mild", "Strong" or "Severe") and, optionally, a numeric rating. The default leaves out the "Mild" entries, like SlurFilter always has."""
+    threshold = SEVERITIES[minimum]
+    return SlurMatcher(
+        entry
+        for entry in inbuilt_slur_entries()
+        if SEVERITIES.get(entry.severity, 0) >= threshold
+        and (minimum_rating is None or entry.rating >= minimum_rating)
+    )
@@ -6,10 +6,13 @@ from personate.utils.logger import logger
 import types
 import discord
 from personate.swarm.internal_message import InternalMessage
-from acrossword import Ranker
+from personate.utils.embeddings import LabelIndex, TurnEmbeddings
 import random
 
 class Translator:
+    # Whether this might change the text of the agent's message, rather than just its embeds or the whitespace around it. Streamed completions are only shown as they're written when nothing in the post-translator chain does, otherwise people would see text the chain was meant to hide or change (CW spoilers, translations).
+    rewrites_content = True
+
     def __init__(self) -> None:
         self.translators: List[Union["Translator", Callable]] = []
         # self.permitted_types: List[type] = []
@@ -17,6 +20,19 @@ class Translator:
     def add_translator(self, translator: Union[Callable, "Translator"]) -> None:
         self.translators.append(translator)
 
+    def rewrites(self) -> bool:
+        """Whether this or anything in its chain might change the text of the agent's message. Plain functions are assumed to, unless they have a `rewrites_content = False` attribute."""
+        if self.rewrites_content:
+            return True
+        return any(
+            translator.rewrites()
+            if isinstance(translator, Translator)
+            else getattr(translator, "rewrites_content", True)
+            for translator in self.translators
+            # Subclasses put their own methods in the chain, and rewrites_content already covers those.
+            if getattr(translator, "__self__", None) is not self
+        )
+
     def retrieve_by_classname(
         self, classname: str
     ) -> Union[None, Callable, "Translator"]:
@@ -68,6 +84,7 @@ class Translator:
 
 class DiscordResponseTranslator(Translator):
     __name__ = "DiscordResponseTranslator"
+    rewrites_content = False
 
     def __init__(self):
         super().__init__()
@@ -97,6 +114,7 @@ class DiscordResponseTranslator(Translator):
 
 class MessageTrimmerTranslator(Translator):
     __name__ = "MessageTrimmerTranslator"
+    rewrites_content = False
 
     def __init__(self):
         super().__init__()
@@ -167,25 +185,26 @@ class CWTaggerTranslator(Translator):
             )
         self.possible_cw_tag_options.extend(self.neutral_options)
         self.__dict__.update(kwargs)
+        self.index = LabelIndex(self.possible_cw_tag_options)
 
     def add_cw_topic(self, topic: str) -> None:
         self.possible_cw_tag_options.append(
             f"{self.standard_boilerplate_prefix} {topic}"
         )
+        self.index.add(self.possible_cw_tag_options[-1])
 
     async def spoiler_text_and_add_cw_tag(
-        self, agent_message: InternalMessage, **kwargs
+        self,
+        agent_message: InternalMessage,
+        embeddings: Optional[TurnEmbeddings] = None,
+        **kwargs,
     ) -> None:
         if not agent_message or (
             not agent_message.internal_content and agent_message.external_content
         ):
             return
-        ranker = Ranker()
-        top_labels: List[str] = await ranker.rank(
-            texts=tuple(self.possible_cw_tag_options),
-            query=agent_message.internal_content,
-            top_k=self.top_k,
-            model=ranker.default_model,
+        top_labels: List[str] = await self.index.classify(
+            agent_message.internal_content, k=self.top_k, embeddings=embeddings
         )
         if top_labels[0] in self.neutral_options:
             return
@@ -241,27 +260,31 @@ class EmojiTranslator(Translator):
         self.filename = file
         self.emojis = final_emojis
         self.__dict__.update(kwargs)
+        self.index = LabelIndex(list(self.emojis.keys()))
 
     def append_emoji(self, tags: str, emoji: Union[str, list]) -> None:
         if isinstance(emoji, str):
             emoji = [emoji]
+        if tags not in self.emojis:
+            self.index.add(tags)
         self.emojis[tags] = emoji
         if self.filename:
             with open(self.filename, "w") as f:
                 json.dump(self.emojis, f, indent=4)
 
-    async def add_emoji_to_message(self, agent_message: InternalMessage, **kwargs):
-        ranker = Ranker()
+    async def add_emoji_to_message(
+        self,
+        agent_message: InternalMessage,
+        embeddings: Optional[TurnEmbeddings] = None,
+        **kwargs,
+    ):
         """Adds an emoji to the text provided based on its semantic similarity to the provided emojis and their labels, does not add an emoji if the result of rank is an empty list."""
         # emojis should look like {"happy, cheerful, good mood": ["<:happy:293844>", "<:some_other_emoji:293833>"]}, etc.
         logger.debug(
             f"I am adding an emoji to the message now: {agent_message.internal_content}"
         )
-        top_labels: List[str] = await ranker.rank(
-            texts=tuple(self.emojis.keys()),
-            query=agent_message.internal_content,
-            top_k=1,
-            model=ranker.default_model,
+        top_labels: List[str] = await self.index.classify(
+            agent_message.internal_content, k=1, embeddings=embeddings
         )
         logger.debug(f"The top labels are: {top_labels}")
         if top_labels:
@@ -333,5 +356,7 @@ class LanguageTranslator(Translator):
 
 
 class EmptyTranslator(Translator):
+    rewrites_content = False
+
     def __init__(self):
         super().__init__()
@@ -1,10 +1,79 @@
 from typing import Optional, List, Dict, Any, Union
+import asyncio
+import aiohttp
 import discord
 from personate.swarm.internal_message import InternalMessage
+from personate.face.webhooks import get_webhook_cache
 from personate.utils.logger import logger
 import random
 
 
+class ThrottledEditor:
+    """
+    Edits a message with the latest text it's been given, at most once every `interval` seconds, so a streamed completion shows up as it's written without running into Discord's rate limits. Anything that arrives while an edit is in flight or waiting out the interval replaces the pending text, so it only ever sends the newest version.
+
+        editor = face.streaming_editor(loading_message)
+        completion = await frame.complete_streaming(editor)
+        await editor.close()
+        await face.update(agent_message, loading_message)
+
+    close() waits for the last edit to finish, so it can't land on top of the final update. reset() puts the message back the way it was (the loading message), for when a completion that's already been shown gets rejected.
+    """
+
+    def __init__(self, message: discord.Message, interval: float = 1.0) -> None:
+        self.message = message
+        self.placeholder = message.content
+        self.interval = interval
+        self.pending: Optional[str] = None
+        self.shown: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.editing = False
+        self.closed = False
+        self.edits = 0
+
+    async def __call__(self, text: str) -> None:
+        if self.closed:
+            return
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def reset(self) -> None:
+        await self(self.placeholder)
+
+    async def run(self) -> None:
+        while self.pending is not None:
+            text, self.pending = self.pending, None
+            if text != self.shown:
+                self.editing = True
+                try:
+                    await self.message.edit(content=text)
+                    self.shown = text
+                    self.edits += 1
+                except discord.HTTPException as e:
+                    logger.debug(f"Couldn't edit a streamed message: {e}")
+                finally:
+                    self.editing = False
+            if self.closed:
+                return
+            await asyncio.sleep(self.interval)
+
+    async def close(self) -> None:
+        self.closed = True
+        self.pending = None
+        if self.task is None or self.task.done():
+            return
+        if self.editing:
+            await self.task
+        else:
+            # It's only waiting out the interval.
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
 class Face:
     """
     This is maybe one of the simplest classes in the library. It manages webhooks and posts as the webhook with a specific appearance (avatar_url and username).
@@ -21,32 +90,15 @@ class Face:
         self.avatar_url = avatar_url
         self.username = username
         self.loading_message = loading_message
-        self.webhooks: Dict[int, discord.Webhook] = {}
+        # Shared with every other Face on this bot.
+        self.webhook_cache = get_webhook_cache(bot)
+        self.webhooks: Dict[int, discord.Webhook] = self.webhook_cache.webhooks
         logger.debug(
             f"Face created with avatar_url: {avatar_url} and username: {username}"
         )
 
     async def get_webhook(self, channel_id: int) -> Optional[discord.Webhook]:
-        channel = self.bot.get_channel(channel_id)
-        if isinstance(channel, discord.TextChannel):
-
-            def predicate(webhook: discord.Webhook):
-                return webhook.user == self.bot.user
-
-            webhooks: List[discord.Webhook] = await channel.webhooks()
-            webhook = discord.utils.find(lambda m: predicate(m), webhooks)
-            if not webhook:
-                if self.bot.user:
-                    try:
-                        webhook = await channel.create_webhook(name=self.bot.user.name)
-                    except discord.HTTPException:
-                        pass
-            if webhook:
-                return webhook
-        logger.debug(
-            f"Was unable to find a webhook for channel: {channel_id}. This might be because the bot lacks the relevant permissions (Manage Webhooks), or for some other bizarre reason."
-        )
-        return None
+        return await self.webhook_cache.get(channel_id)
 
     async def send_custom(
         self,
@@ -59,6 +111,20 @@ class Face:
         """Flexible method that handles different cases."""
         webhook = await self.get_webhook(channel.id)
         logger.debug(f"Sent message to channel: {channel.id} with content: {content}")
+        if webhook:
+            try:
+                return await webhook.send(
+                    content=content,
+                    avatar_url=avatar_url,
+                    username=username,
+                    wait=True,
+                    **kwargs,
+                )
+            except (discord.NotFound, discord.Forbidden, aiohttp.ClientError, RuntimeError):
+                # The cached webhook was deleted, we can't use it anymore, or its session is gone
+                # ("Event loop is closed"). Look it up again, once.
+                self.webhook_cache.invalidate(channel.id)
+                webhook = await self.get_webhook(channel.id)
         if webhook:
             return await webhook.send(
                 content=content,
@@ -90,6 +156,11 @@ class Face:
             channel, content, self.avatar_url, self.username, **kwargs
         )
 
+    def streaming_editor(
+        self, message: discord.Message, interval: float = 1.0
+    ) -> ThrottledEditor:
+        return ThrottledEditor(message, interval)
+
     async def update(
         self,
         agent_message: InternalMessage,
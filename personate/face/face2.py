@@ -1,5 +1,7 @@
 from typing import Optional, List, Dict, Any, Union
+import aiohttp
 import discord
+from personate.face.webhooks import get_webhook_cache
 from personate.utils.logger import logger
 import random
 
@@ -26,32 +28,15 @@ class Face:
         self.avatar_url = avatar_url
         self.username = username
         self.loading_message = loading_message
-        self.webhooks: Dict[int, discord.Webhook] = {}
+        # Shared with every other Face on this bot.
+        self.webhook_cache = get_webhook_cache(bot)
+        self.webhooks: Dict[int, discord.Webhook] = self.webhook_cache.webhooks
         logger.debug(
             f"Face created with avatar_url: {avatar_url} and username: {username}"
         )
 
     async def get_webhook(self, channel_id: int) -> Optional[discord.Webhook]:
-        channel = self.bot.get_channel(channel_id)
-        if isinstance(channel, discord.TextChannel):
-
-            def predicate(webhook: discord.Webhook):
-                return webhook.user == self.bot.user
-
-            webhooks: List[discord.Webhook] = await channel.webhooks()
-            webhook = discord.utils.find(lambda m: predicate(m), webhooks)
-            if not webhook:
-                if self.bot.user:
-                    try:
-                        webhook = await channel.create_webhook(name=self.bot.user.name)
-                    except discord.HTTPException:
-                        pass
-            if webhook:
-                return webhook
-        logger.debug(
-            f"Was unable to find a webhook for channel: {channel_id}. This might be because the bot lacks the relevant permissions (Manage Webhooks), or for some other bizarre reason."
-        )
-        return None
+        return await self.webhook_cache.get(channel_id)
 
     async def send_custom(
         self,
@@ -69,6 +54,21 @@ class Face:
             )
         webhook = await self.get_webhook(channel.id)
         logger.debug(f"Sent message to channel: {channel.id} with content: {content}")
+        if webhook:
+            try:
+                message = await webhook.send(
+                    content=content,
+                    avatar_url=avatar_url,
+                    username=username,
+                    wait=True,
+                    **kwargs,
+                )
+                return UpdateableMessageWrapper(message)
+            except (discord.NotFound, discord.Forbidden, aiohttp.ClientError, RuntimeError):
+                # The cached webhook was deleted, we can't use it anymore, or its session is gone
+                # ("Event loop is closed"). Look it up again, once.
+                self.webhook_cache.invalidate(channel.id)
+                webhook = await self.get_webhook(channel.id)
         if webhook:
             message = await webhook.send(
                 content=content,
@@ -0,0 +1,127 @@
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import time
+import weakref
+import discord
+from personate.utils.logger import logger
+
+
+class WebhookCache:
+    """
+    The webhook the bot posts through in each channel, looked up (or created) the first time it's needed and then kept, so sending a message doesn't cost a `channel.webhooks()` request every time. Every Face on the same bot shares one of these (see get_webhook_cache), so several Agents in one channel only ever look it up once.
+
+    If a webhook turns out to be gone (someone deleted it, or the bot lost Manage Webhooks), call invalidate() and the next get() looks it up again. Channels where we couldn't get a webhook at all are remembered for `retry_after` seconds, so they fall back to plain messages without asking Discord every time.
+
+    A Webhook object sends through the HTTP session of the login that fetched it, and Agent.run logs in again on a new event loop every 400 seconds. So the objects are only kept for the loop they were made on. What's kept across loops is each webhook's id and token, and the next get() on a new loop rebuilds the webhook on the live session with Webhook.partial, without asking Discord.
+    """
+
+    def __init__(self, bot: discord.Bot, retry_after: float = 300) -> None:
+        self.bot = bot
+        self.retry_after = retry_after
+        # channel id -> webhook, only for self.loop.
+        self.webhooks: Dict[int, discord.Webhook] = {}
+        # channel id -> (webhook id, webhook token), for every loop.
+        self.tokens: Dict[int, Tuple[int, str]] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.unavailable: Dict[int, float] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.hits = 0
+        self.lookups = 0
+        self.invalidations = 0
+
+    def session(self):
+        """The aiohttp session the bot is logged in with right now, if it has one."""
+        session = getattr(self.bot.http, "_HTTPClient__session", None)
+        if session is None or session is discord.utils.MISSING or session.closed:
+            return None
+        return session
+
+    def rebuild(self, channel_id: int) -> Optional[discord.Webhook]:
+        """Remakes a webhook we've seen before (on an earlier loop) on the current session."""
+        ids = self.tokens.get(channel_id)
+        session = self.session()
+        if ids is None or session is None:
+            return None
+        webhook_id, token = ids
+        return discord.Webhook.partial(
+            webhook_id, token, session=session, bot_token=self.bot.http.token
+        )
+
+    async def get(self, channel_id: int) -> Optional[discord.Webhook]:
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Cleared in place: every Face's .webhooks is this dict.
+            self.webhooks.clear()
+            self.locks.clear()
+            self.loop = loop
+        webhook = self.webhooks.get(channel_id)
+        if webhook is not None:
+            self.hits += 1
+            return webhook
+        lock = self.locks.setdefault(channel_id, asyncio.Lock())
+        async with lock:
+            # Whoever held the lock before us might have just found it.
+            webhook = self.webhooks.get(channel_id)
+            if webhook is not None:
+                self.hits += 1
+                return webhook
+            if time.monotonic() < self.unavailable.get(channel_id, 0):
+                return None
+            webhook = self.rebuild(channel_id) or await self.fetch(channel_id)
+            if webhook is None:
+                self.unavailable[channel_id] = time.monotonic() + self.retry_after
+            else:
+                self.webhooks[channel_id] = webhook
+                if webhook.token:
+                    self.tokens[channel_id] = (webhook.id, webhook.token)
+                self.unavailable.pop(channel_id, None)
+            return webhook
+
+    async def fetch(self, channel_id: int) -> Optional[discord.Webhook]:
+        channel = self.bot.get_channel(channel_id)
+        if not isinstance(channel, discord.TextChannel):
+            return None
+        self.lookups += 1
+        try:
+            webhooks: List[discord.Webhook] = await channel.webhooks()
+        except discord.HTTPException as e:
+            logger.debug(f"Couldn't list the webhooks for channel {channel_id}: {e}")
+            return None
+        webhook = discord.utils.find(lambda m: m.user == self.bot.user, webhooks)
+        if not webhook and self.bot.user:
+            try:
+                webhook = await channel.create_webhook(name=self.bot.user.name)
+            except discord.HTTPException:
+                pass
+        if not webhook:
+            logger.debug(
+                f"Was unable to find a webhook for channel: {channel_id}. This might be because the bot lacks the relevant permissions (Manage Webhooks), or for some other bizarre reason."
+            )
+        return webhook
+
+    def invalidate(self, channel_id: int) -> None:
+        """Forgets the webhook for a channel, e.g. after Discord says it doesn't exist anymore."""
+        if self.webhooks.pop(channel_id, None) is not None:
+            self.invalidations += 1
+        self.tokens.pop(channel_id, None)
+        self.unavailable.pop(channel_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "channels": len(self.webhooks),
+            "unavailable": len(self.unavailable),
+            "hits": self.hits,
+            "lookups": self.lookups,
+            "invalidations": self.invalidations,
+        }
+
+
+webhook_caches: "weakref.WeakKeyDictionary[discord.Bot, WebhookCache]" = weakref.WeakKeyDictionary()
+
+
+def get_webhook_cache(bot: discord.Bot) -> WebhookCache:
+    """The WebhookCache for a bot, shared by every Face that uses it."""
+    cache = webhook_caches.get(bot)
+    if cache is None:
+        cache = webhook_caches[bot] = WebhookCache(bot)
+    return cache
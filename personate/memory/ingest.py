@@ -0,0 +1,101 @@
+import asyncio
+from typing import Dict, Iterable, Optional, Set
+
+import discord
+from personate.memory.memory import Memory
+from personate.memory.store import RAW
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+def to_internal(message: discord.Message) -> InternalMessage:
+    internal_message = InternalMessage.from_discord_message(message)
+    try:
+        # Personate chatbots put the id of the message they replied to in the footer of their embed.
+        internal_message.reply_to = int(str(message.embeds[0].footer.text))
+    except (IndexError, ValueError):
+        pass
+    return internal_message
+
+
+class Ingest:
+    """
+    Writes every message the bot sees into Memory as it arrives, so that replying doesn't have to ask Discord for the channel's history first.
+
+    History is only fetched to fill gaps: the first time we reply in a channel after starting up, and after the gateway disconnects (we never hear about messages that were sent while we were away). For each channel it keeps a high-water mark, the newest message id it has stored, and a backfill stops as soon as it gets back to the mark it had when the gap started. So in a channel we've been watching the whole time, catch_up doesn't touch the API at all.
+
+        ingest.stats()
+        # {'observed': 5120, 'backfills': 3, 'fetched': 30, 'channels': 12, 'synced': 9}
+    """
+
+    def __init__(
+        self,
+        memory: Memory,
+        ignore_names: Optional[Iterable[str]] = None,
+        backfill_limit: int = 10,
+    ) -> None:
+        self.memory = memory
+        # An Agent stores its own messages itself, after they've been translated.
+        self.ignore_names: Set[str] = set(ignore_names or [])
+        self.backfill_limit = backfill_limit
+        self.high_water: Dict[int, int] = {}
+        # Where each channel's history stopped being contiguous, if we know.
+        self.gaps: Dict[int, int] = {}
+        self.synced: Set[int] = set()
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.observed = 0
+        self.backfills = 0
+        self.fetched = 0
+
+    def observe(self, message: discord.Message) -> None:
+        channel_id = message.channel.id
+        if message.author.name not in self.ignore_names:
+            self.memory.insert_message(message.id, to_internal(message), RAW)
+            self.observed += 1
+        if message.id > self.high_water.get(channel_id, 0):
+            self.high_water[channel_id] = message.id
+
+    def mark_stale(self) -> None:
+        """Call this when the connection drops. Every channel needs a backfill before we can trust what's in Memory again."""
+        for channel_id in self.synced:
+            self.gaps[channel_id] = self.high_water.get(channel_id, 0)
+        self.synced.clear()
+
+    async def catch_up(self, channel: discord.abc.Messageable) -> int:
+        """Backfills a channel's recent history if it isn't synced yet. Returns how many messages were added."""
+        channel_id = channel.id  # type: ignore
+        if channel_id in self.synced:
+            return 0
+        lock = self.locks.setdefault(channel_id, asyncio.Lock())
+        async with lock:
+            if channel_id in self.synced:
+                return 0
+            mark = self.gaps.get(channel_id, 0)
+            history = []
+            async for message in channel.history(limit=self.backfill_limit):
+                if message.id <= mark:
+                    break
+                history.append(message)
+            new_ids = set(self.memory.new_message_ids(message.id for message in history))
+            added = 0
+            for message in reversed(history):
+                if message.id in new_ids and message.author.name not in self.ignore_names:
+                    self.memory.insert_message(message.id, to_internal(message), RAW)
+                    added += 1
+                if message.id > self.high_water.get(channel_id, 0):
+                    self.high_water[channel_id] = message.id
+            self.backfills += 1
+            self.fetched += len(history)
+            self.gaps.pop(channel_id, None)
+            self.synced.add(channel_id)
+            logger.debug(f"Backfilled {added} messages in channel {channel_id}")
+            return added
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "observed": self.observed,
+            "backfills": self.backfills,
+            "fetched": self.fetched,
+            "channels": len(self.high_water),
+            "synced": len(self.synced),
+        }
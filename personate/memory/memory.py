@@ -1,7 +1,10 @@
-from typing import List, Union, Optional, Any
+from typing import Iterable, List, Union, Optional, Any
 import discord
 from sqlitedict import SqliteDict
 from personate.swarm.internal_message import InternalMessage
+from personate.memory.store import TRANSLATED, MessageStore
+from personate.memory.recent import RecentMessages
+from personate.memory.retention import Retention, RetentionPolicy
 
 
 class Memory:
@@ -13,19 +16,60 @@ class Memory:
         """
         Initialise a Memory object from an existing database, or create a new one.
         """
-        db = SqliteDict(db_path, autocommit=True)
+        db = SqliteDict(db_path, autocommit=True, journal_mode="WAL")
         return cls(db=db)
 
-    def __init__(self, db: Optional[SqliteDict] = None):
+    def __init__(self, db: Optional[SqliteDict] = None, recent_size: int = 2048):
         if db is None:
-            db = SqliteDict("messages.sqlite", autocommit=True)
+            db = SqliteDict("messages.sqlite", autocommit=True, journal_mode="WAL")
         self.db: SqliteDict = db
+        # Messages live in their own typed table in the same file, everything else stays in the SqliteDict.
+        self.messages = MessageStore(db.filename)
+        if self.messages.is_empty():
+            self.messages.migrate_from(self.db)
+        self.recent = RecentMessages(maximum=recent_size)
+        self.retention: Optional[Retention] = None
 
-    def insert_message(self, message_id: int, message: InternalMessage):
-        files = message.files
-        del message.files
-        self.db[message_id] = message
-        message.files = files
+    def insert_message(
+        self, message_id: int, message: InternalMessage, source: int = TRANSLATED
+    ):
+        """Stores a message. Pass source=RAW for messages straight from Discord, which never replace one that's been through the translators."""
+        row = MessageStore.to_row(message_id, message, source)
+        self.recent.put_row(row)
+        self.messages.put_rows([row])
+
+    def get_message(self, message_id: int) -> Optional[InternalMessage]:
+        message = self.recent.get(message_id)
+        if message is None:
+            message = self.messages.get(message_id)
+            if message is not None:
+                self.recent.put(message_id, message)
+        return message
+
+    def has_message(self, message_id: int) -> bool:
+        """An indexed existence check. Use this instead of `message_id in memory.db.keys()`, which scans the whole table."""
+        return message_id in self.recent or self.messages.contains(message_id)
+
+    def new_message_ids(self, message_ids: Iterable[int]) -> List[int]:
+        """Returns the ids (in the order given) that aren't stored yet, resolving all of them in one query."""
+        message_ids = list(message_ids)
+        unknown = [i for i in message_ids if i not in self.recent]
+        existing = self.messages.existing(unknown)
+        return [i for i in unknown if i not in existing]
+
+    def flush(self) -> None:
+        """Writes any buffered messages to disk straight away."""
+        self.messages.flush()
+
+    def use_retention(self, policy: RetentionPolicy) -> None:
+        """Prune (and optionally archive) old messages according to the policy. Nothing happens until start_retention is called from inside the event loop."""
+        if self.retention is not None:
+            self.retention.stop()
+        self.retention = Retention(self.messages, policy, self.recent)
+
+    def start_retention(self) -> None:
+        if self.retention is not None:
+            self.retention.start()
 
     async def retrieve_reply_chain(
         self,
@@ -33,27 +77,29 @@ class Memory:
         window_size: int = 15,
         max_characters: int = 800,
     ) -> List[InternalMessage]:
-        past_messages: List[InternalMessage] = []
         if isinstance(message, discord.Message):
             msg = InternalMessage.from_discord_message(message)
         else:
             msg = message
-        last_id = msg.id
-        for _ in range(window_size):
-            past_messages.append(msg)
-            # try:
-            # if isinstance(msg, discord.Message) and msg.reference and msg.reference.resolved:
-            # last_id = msg.reference.resolved.id
-            # except AttributeError:
-            if hasattr(msg, "reply_to") and isinstance(msg, InternalMessage):
-                last_id = msg.reply_to
-            else:
-                break
-            msg = self.db.get(last_id, None)
-            if not msg:
-                break
-            if sum([len(m.internal_content) for m in past_messages]) > max_characters:
+        past_messages: List[InternalMessage] = [msg]
+        total = len(msg.internal_content)
+        reply_to = getattr(msg, "reply_to", 0)
+        # Walk through the recent tier for as long as we can, then let SQLite finish the chain in one query.
+        while reply_to and len(past_messages) < window_size and total <= max_characters:
+            parent = self.recent.get(reply_to)
+            if parent is None:
+                past_messages.extend(
+                    self.messages.reply_chain(
+                        reply_to=reply_to,
+                        start=total,
+                        window_size=window_size - len(past_messages) + 1,
+                        max_characters=max_characters,
+                    )
+                )
                 break
+            past_messages.append(parent)
+            total += len(parent.internal_content)
+            reply_to = parent.reply_to
         past_messages.reverse()
         return past_messages
 
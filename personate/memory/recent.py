@@ -0,0 +1,77 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+from personate.memory.store import RAW, MessageStore, Row
+from personate.swarm.internal_message import InternalMessage
+
+
+class RecentMessages:
+    """
+    A bounded, in-process tier for the messages we've seen most recently, sitting in front of the MessageStore. Nearly every reply chain we walk is made of messages from the last few minutes, so most lookups never need to touch SQLite.
+
+    Entries are kept as rows rather than objects, so every get() hands back a fresh InternalMessage and nobody can change what's stored by mutating what they were given. It's write-through: Memory puts every message here and in the store at the same time.
+
+    hits and misses are counted so you can size it – look at memory.recent.stats().
+    """
+
+    def __init__(self, maximum: int = 2048, per_channel: int = 64) -> None:
+        self.maximum = maximum
+        self.per_channel = per_channel
+        self.rows: "OrderedDict[int, Row]" = OrderedDict()
+        self.channels: Dict[int, Deque[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self.rows
+
+    def put(self, message_id: int, message: InternalMessage) -> None:
+        self.put_row(MessageStore.to_row(message_id, message))
+
+    def put_row(self, row: Row) -> None:
+        message_id, channel_id = row[0], row[1]
+        held = self.rows.get(message_id)
+        if row[9] == RAW and held is not None and held[9] != RAW:
+            return
+        if held is None:
+            self.channels.setdefault(channel_id, deque(maxlen=self.per_channel)).append(
+                message_id
+            )
+        self.rows[message_id] = row
+        self.rows.move_to_end(message_id)
+        while len(self.rows) > self.maximum:
+            self.rows.popitem(last=False)
+
+    def evict_before(self, cutoff: int) -> int:
+        """Drops every message with an id below the cutoff, e.g. after Retention has pruned them from the store."""
+        evicted = [message_id for message_id in self.rows if message_id < cutoff]
+        for message_id in evicted:
+            del self.rows[message_id]
+        return len(evicted)
+
+    def get(self, message_id: int) -> Optional[InternalMessage]:
+        row = self.rows.get(message_id)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.rows.move_to_end(message_id)
+        return MessageStore.from_row(row)
+
+    def in_channel(self, channel_id: int) -> List[InternalMessage]:
+        """The most recent messages we still hold for a channel, oldest first."""
+        return [
+            MessageStore.from_row(self.rows[message_id])
+            for message_id in self.channels.get(channel_id, ())
+            if message_id in self.rows
+        ]
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.rows),
+            "channels": len(self.channels),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,219 @@
+import asyncio
+import gzip
+import os
+import sqlite3
+import time
+from typing import Dict, Optional
+
+import orjson
+from personate.memory.recent import RecentMessages
+from personate.memory.store import COLUMNS, MessageStore
+from personate.utils.logger import logger
+
+# Discord ids are snowflakes: the top 42 bits are milliseconds since the start of 2015.
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_at(timestamp: float) -> int:
+    """The smallest message id Discord could have handed out at this unix time."""
+    return max(int(timestamp * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+class RetentionPolicy:
+    """
+    How much message history a Memory keeps around.
+        max_age: seconds. Messages older than this get pruned. Since message ids are snowflakes, this is a range delete on the primary key and doesn't need a timestamp column.
+        max_messages: keep at most this many of the newest messages.
+        archive_directory: if set, pruned messages are written there as gzipped JSON-lines segments before they're deleted, instead of just being dropped.
+        interval: seconds between pruning passes.
+        vacuum_after: VACUUM the database once this many rows have been deleted since the last one.
+    """
+
+    def __init__(
+        self,
+        max_age: Optional[float] = 90 * 24 * 60 * 60,
+        max_messages: Optional[int] = None,
+        archive_directory: Optional[str] = None,
+        interval: float = 60 * 60,
+        vacuum_after: int = 20000,
+    ) -> None:
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.archive_directory = archive_directory
+        self.interval = interval
+        self.vacuum_after = vacuum_after
+
+    @classmethod
+    def from_dict(cls, data: dict, home_dir: str = ".") -> "RetentionPolicy":
+        max_age_days = data.get("max_age_days", 90)
+        archive = data.get("archive", True)
+        return cls(
+            max_age=max_age_days * 24 * 60 * 60 if max_age_days else None,
+            max_messages=data.get("max_messages", None),
+            archive_directory=(archive if isinstance(archive, str) else home_dir + "/archive")
+            if archive
+            else None,
+            interval=data.get("interval", 60 * 60),
+            vacuum_after=data.get("vacuum_after", 20000),
+        )
+
+
+class Retention:
+    """
+    Prunes a MessageStore according to a RetentionPolicy, in the background. Each pass runs on its own connection in a worker thread: WAL mode lets the bot keep reading while a pass archives and deletes, so lookups stay quick however long the bot has been running.
+
+    Every so often it VACUUMs too, which needs the database to itself for as long as it takes. The store is flushed and paused first, so its writes wait in the buffer instead of timing out against the lock.
+
+    When the last pass ran is kept in the database, so restarting (Agent.run does every 400 seconds) doesn't set off a pass early. Pruned messages are dropped from `recent` too, if it's given, so reply chains can't find them there.
+    """
+
+    def __init__(
+        self,
+        store: MessageStore,
+        policy: RetentionPolicy,
+        recent: Optional[RecentMessages] = None,
+    ) -> None:
+        self.store = store
+        self.policy = policy
+        self.recent = recent
+        self.deleted_since_vacuum = 0
+        self.last_cutoff = 0
+        self.task: Optional[asyncio.Task] = None
+        self.totals: Dict[str, int] = {"passes": 0, "archived": 0, "deleted": 0, "vacuums": 0}
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run_forever())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            last_run = await loop.run_in_executor(None, self.last_run_sync)
+            delay = last_run + self.policy.interval - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await self.prune()
+            except Exception:
+                logger.exception("Pruning the message database failed, I'll try again later")
+            # Even if it failed, or it'd be retried straight away.
+            await loop.run_in_executor(None, self.record_run_sync, time.time())
+
+    def last_run_sync(self) -> float:
+        connection = sqlite3.connect(self.store.path, timeout=30)
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS retention (id INTEGER PRIMARY KEY CHECK (id = 0), last_run REAL NOT NULL)"
+            )
+            row = connection.execute("SELECT last_run FROM retention").fetchone()
+            return row[0] if row else 0.0
+        finally:
+            connection.close()
+
+    def record_run_sync(self, timestamp: float) -> None:
+        connection = sqlite3.connect(self.store.path, timeout=30)
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO retention (id, last_run) VALUES (0, ?)", (timestamp,)
+                )
+        finally:
+            connection.close()
+
+    async def prune(self) -> int:
+        self.store.flush()
+        loop = asyncio.get_running_loop()
+        deleted = await loop.run_in_executor(None, self.prune_sync)
+        if deleted and self.recent is not None:
+            self.recent.evict_before(self.last_cutoff)
+        self.totals["passes"] += 1
+        if self.deleted_since_vacuum >= self.policy.vacuum_after:
+            self.store.flush()
+            self.store.paused = True
+            try:
+                await loop.run_in_executor(None, self.vacuum_sync)
+            finally:
+                self.store.paused = False
+                self.store.flush()
+        return deleted
+
+    def vacuum_sync(self) -> None:
+        connection = sqlite3.connect(self.store.path, timeout=30)
+        try:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+        self.deleted_since_vacuum = 0
+        self.totals["vacuums"] += 1
+
+    def cutoff(self, connection: sqlite3.Connection) -> int:
+        """Every message with an id below this one gets pruned."""
+        cutoff = 0
+        if self.policy.max_age:
+            cutoff = snowflake_at(time.time() - self.policy.max_age)
+        if self.policy.max_messages:
+            row = connection.execute(
+                "SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (self.policy.max_messages - 1,),
+            ).fetchone()
+            if row:
+                cutoff = max(cutoff, row[0])
+        return cutoff
+
+    def prune_sync(self) -> int:
+        connection = sqlite3.connect(self.store.path, timeout=30)
+        try:
+            cutoff = self.cutoff(connection)
+            if not cutoff:
+                return 0
+            self.last_cutoff = cutoff
+            if self.policy.archive_directory:
+                deleted = self.archive_and_delete(connection, cutoff)
+            else:
+                with connection:
+                    deleted = connection.execute(
+                        "DELETE FROM messages WHERE id < ?", (cutoff,)
+                    ).rowcount
+            self.totals["deleted"] += deleted
+            self.deleted_since_vacuum += deleted
+            if deleted:
+                logger.info(f"Pruned {deleted} messages from {self.store.path}")
+            return deleted
+        finally:
+            connection.close()
+
+    def archive_and_delete(
+        self, connection: sqlite3.Connection, cutoff: int, segment_size: int = 50000
+    ) -> int:
+        """Moves everything below the cutoff into gzipped JSON-lines segments, one segment (and one transaction) at a time."""
+        directory = self.policy.archive_directory or "."
+        os.makedirs(directory, exist_ok=True)
+        names = COLUMNS.split(", ")
+        deleted = 0
+        while True:
+            rows = connection.execute(
+                f"SELECT {COLUMNS} FROM messages WHERE id < ? ORDER BY id LIMIT ?",
+                (cutoff, segment_size),
+            ).fetchall()
+            if not rows:
+                return deleted
+            path = f"{directory}/messages-{rows[0][0]}-{rows[-1][0]}.jsonl.gz"
+            with gzip.open(path, "wb") as f:
+                for row in rows:
+                    record = dict(zip(names, row))
+                    if record["embeds"]:
+                        record["embeds"] = orjson.loads(record["embeds"])
+                    f.write(orjson.dumps(record) + b"\n")
+            with connection:
+                deleted += connection.execute(
+                    "DELETE FROM messages WHERE id <= ? AND id < ?", (rows[-1][0], cutoff)
+                ).rowcount
+            self.totals["archived"] += len(rows)
+            logger.info(f"Archived {len(rows)} messages to {path}")
@@ -0,0 +1,300 @@
+import asyncio
+import atexit
+import pickle
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from personate.swarm.internal_message import InternalMessage, encode_embeds
+from personate.utils.logger import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL DEFAULT 0,
+    reply_to INTEGER NOT NULL DEFAULT 0,
+    author_id INTEGER,
+    name TEXT NOT NULL DEFAULT '',
+    internal_content TEXT NOT NULL DEFAULT '',
+    external_content TEXT NOT NULL DEFAULT '',
+    embeds BLOB,
+    format INTEGER NOT NULL DEFAULT 1,
+    source INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS messages_reply_to ON messages (reply_to);
+CREATE INDEX IF NOT EXISTS messages_channel_id ON messages (channel_id, id);
+"""
+
+COLUMNS = "id, channel_id, reply_to, author_id, name, internal_content, external_content, embeds, format, source"
+
+# 1: embeds pickled (only ever found in databases written before this was versioned)
+# 2: embeds as JSON from Embed.to_dict, decoded lazily by InternalMessage
+ROW_FORMAT = 2
+
+# Where a row came from. Messages an Agent stores while replying have been through its translator chains; RAW ones are
+# straight from Discord (Ingest). A RAW row never replaces a TRANSLATED one, so what later prompts see doesn't depend on
+# which of the two got there last.
+RAW = 0
+TRANSLATED = 1
+
+INSERT = f"INSERT OR REPLACE INTO messages ({COLUMNS}) VALUES ({', '.join('?' * len(COLUMNS.split(', ')))})"
+INSERT_RAW = (
+    f"INSERT INTO messages ({COLUMNS}) VALUES ({', '.join('?' * len(COLUMNS.split(', ')))}) "
+    f"ON CONFLICT (id) DO UPDATE SET "
+    + ", ".join(f"{column} = excluded.{column}" for column in COLUMNS.split(", ")[1:])
+    + f" WHERE messages.source = {RAW}"
+)
+
+# Walks up the reply chain inside SQLite. A parent is only included while the messages before it
+# (starting with the one we were given, which isn't necessarily stored yet) fit in the character budget.
+REPLY_CHAIN = f"""
+WITH RECURSIVE chain (id, reply_to, depth, total) AS (
+    SELECT id, reply_to, 1, :start + length(internal_content)
+    FROM messages
+    WHERE id = :reply_to AND :start <= :max_characters AND 1 < :window_size
+    UNION ALL
+    SELECT messages.id, messages.reply_to, chain.depth + 1, chain.total + length(messages.internal_content)
+    FROM messages JOIN chain ON messages.id = chain.reply_to
+    WHERE chain.depth + 1 < :window_size AND chain.total <= :max_characters
+)
+SELECT {", ".join("messages." + column for column in COLUMNS.split(", "))}
+FROM chain JOIN messages ON messages.id = chain.id
+ORDER BY chain.depth
+"""
+
+Row = Tuple[int, int, int, Optional[int], str, str, str, Optional[bytes], int, int]
+
+
+class MessageStore:
+    """
+    Stores InternalMessages in a typed table with indexes on reply_to and channel_id, instead of pickling them whole into a SqliteDict. The main win is retrieve_reply_chain: the whole chain comes back from one recursive query rather than one lookup (and one unpickle) per hop.
+
+    Writes are buffered and flushed as a single transaction, either once `batch_size` messages are waiting or `flush_interval` seconds after the first one arrived, whichever comes first. Reads check the buffer before the table, and reply_chain flushes first, so whatever you just inserted is always visible. The database runs in WAL mode, so flushes don't block readers.
+
+    Rows only leave the buffer once their transaction has committed. If a flush fails (say the database is locked for longer than `busy_timeout` seconds), they stay buffered and it's tried again `retry_interval` seconds later. Flushes run on the event loop's thread, so `busy_timeout` is kept short: it's how long a locked database can hold up the whole bot.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 256,
+        flush_interval: float = 0.5,
+        busy_timeout: float = 1,
+        retry_interval: float = 5,
+    ) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.pending: Dict[int, Row] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # The loop flush_handle belongs to. Agent.run starts a new loop every so often, and a timer on the old one never fires.
+        self.flush_loop: Optional[asyncio.AbstractEventLoop] = None
+        # Set while something else needs the database to itself (Retention's VACUUM). Writes stay buffered until it's cleared.
+        self.paused = False
+        self.connection = sqlite3.connect(
+            path, timeout=busy_timeout, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        self.upgrade()
+        atexit.register(self.flush)
+
+    def upgrade(self) -> None:
+        """Brings rows written in older formats up to ROW_FORMAT, so that reads never have to unpickle anything."""
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(messages)")]
+        with self.connection:
+            if "format" not in columns:
+                self.connection.execute(
+                    "ALTER TABLE messages ADD COLUMN format INTEGER NOT NULL DEFAULT 1"
+                )
+            if "source" not in columns:
+                # Everything stored before Ingest existed was written by the Agent itself.
+                self.connection.execute(
+                    "ALTER TABLE messages ADD COLUMN source INTEGER NOT NULL DEFAULT 1"
+                )
+            legacy = self.connection.execute(
+                "SELECT id, embeds FROM messages WHERE format = 1 AND embeds IS NOT NULL"
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE messages SET embeds = ? WHERE id = ?",
+                [(encode_embeds(pickle.loads(embeds)), message_id) for message_id, embeds in legacy],
+            )
+            self.connection.execute(
+                "UPDATE messages SET format = ? WHERE format < ?", (ROW_FORMAT, ROW_FORMAT)
+            )
+        if legacy:
+            logger.info(f"Re-encoded the embeds of {len(legacy)} messages in {self.path}")
+
+    def is_empty(self) -> bool:
+        if self.pending:
+            return False
+        return self.connection.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+
+    @staticmethod
+    def to_row(message_id: int, message: InternalMessage, source: int = TRANSLATED) -> Row:
+        return (
+            message_id,
+            getattr(message, "channel_id", 0) or 0,
+            getattr(message, "reply_to", 0) or 0,
+            getattr(message, "author_id", None),
+            getattr(message, "name", ""),
+            getattr(message, "internal_content", ""),
+            getattr(message, "external_content", ""),
+            encode_embeds(getattr(message, "_embeds", None)),
+            ROW_FORMAT,
+            source,
+        )
+
+    @staticmethod
+    def from_row(row: Row) -> InternalMessage:
+        message = InternalMessage()
+        (
+            message.id,
+            message.channel_id,
+            message.reply_to,
+            author_id,
+            message.name,
+            message.internal_content,
+            message.external_content,
+            embeds,
+            _,
+            _,
+        ) = row
+        if author_id is not None:
+            message.author_id = author_id
+        if embeds:
+            message.embeds = embeds
+        return message
+
+    def put(self, message_id: int, message: InternalMessage) -> None:
+        self.put_many([(message_id, message)])
+
+    def put_many(self, messages: Iterable[Tuple[int, InternalMessage]]) -> None:
+        # The row is built now, so later changes to the message object don't leak into what gets stored.
+        self.put_rows(self.to_row(message_id, message) for message_id, message in messages)
+
+    def put_rows(self, rows: Iterable[Row]) -> None:
+        for row in rows:
+            if row[9] == RAW:
+                buffered = self.pending.get(row[0])
+                if buffered is not None and buffered[9] != RAW:
+                    continue
+            self.pending[row[0]] = row
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.pending and not self.schedule_flush(self.flush_interval):
+            self.flush()
+
+    def schedule_flush(self, delay: float) -> bool:
+        """Makes sure a flush is coming on the running loop, at most `delay` seconds from now. Returns False if there's no running loop to schedule it on."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self.flush_handle is not None:
+            if self.flush_loop is loop:
+                return True
+            self.flush_handle.cancel()
+        self.flush_handle = loop.call_later(delay, self.flush)
+        self.flush_loop = loop
+        return True
+
+    def flush(self) -> bool:
+        """Writes the buffered rows in one transaction. Returns False if that failed, in which case they're still buffered and another flush has been scheduled."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return True
+        if self.paused:
+            self.schedule_flush(self.retry_interval)
+            return False
+        rows = list(self.pending.values())
+        try:
+            with self.connection:
+                self.connection.executemany(INSERT, [row for row in rows if row[9] != RAW])
+                self.connection.executemany(INSERT_RAW, [row for row in rows if row[9] == RAW])
+        except sqlite3.Error as e:
+            logger.error(
+                f"Couldn't write {len(rows)} messages to {self.path}, they'll stay buffered until the next flush: {e}"
+            )
+            self.schedule_flush(self.retry_interval)
+            return False
+        for row in rows:
+            # Unless it was replaced by a newer version in the meantime.
+            if self.pending.get(row[0]) is row:
+                del self.pending[row[0]]
+        return True
+
+    def get(self, message_id: int) -> Optional[InternalMessage]:
+        if message_id in self.pending:
+            return self.from_row(self.pending[message_id])
+        row = self.connection.execute(
+            f"SELECT {COLUMNS} FROM messages WHERE id = ?", (message_id,)
+        ).fetchone()
+        return self.from_row(row) if row else None
+
+    def contains(self, message_id: int) -> bool:
+        if message_id in self.pending:
+            return True
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM messages WHERE id = ?", (message_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def existing(self, message_ids: Iterable[int]) -> Set[int]:
+        """Which of these ids are already stored, found with a single primary-key lookup."""
+        ids = set(message_ids)
+        found = {message_id for message_id in ids if message_id in self.pending}
+        remaining = list(ids - found)
+        if remaining:
+            placeholders = ", ".join("?" * len(remaining))
+            found.update(
+                row[0]
+                for row in self.connection.execute(
+                    f"SELECT id FROM messages WHERE id IN ({placeholders})", remaining
+                )
+            )
+        return found
+
+    def reply_chain(
+        self,
+        reply_to: int,
+        start: int = 0,
+        window_size: int = 15,
+        max_characters: int = 800,
+    ) -> List[InternalMessage]:
+        """Returns the ancestors of a message, nearest first. `start` is the length of the message itself, which counts towards the budget."""
+        if not reply_to:
+            return []
+        self.flush()
+        rows = self.connection.execute(
+            REPLY_CHAIN,
+            {
+                "reply_to": reply_to,
+                "start": start,
+                "window_size": window_size,
+                "max_characters": max_characters,
+            },
+        ).fetchall()
+        return [self.from_row(row) for row in rows]
+
+    def migrate_from(self, db) -> int:
+        """Copies pickled InternalMessages out of an old SqliteDict into this table, and removes them from the SqliteDict. They're written in one transaction of their own rather than through the buffer, so if that fails it raises and the SqliteDict is left as it was, to be tried again next time."""
+        migrated = [
+            (key, value) for key, value in db.items() if isinstance(value, InternalMessage)
+        ]
+        if not migrated:
+            return 0
+        with self.connection:
+            self.connection.executemany(
+                INSERT, [self.to_row(int(key), message) for key, message in migrated]
+            )
+        for key, _ in migrated:
+            del db[key]
+        logger.info(f"Moved {len(migrated)} messages from {db.filename} into the message table")
+        return len(migrated)
@@ -4,7 +4,9 @@ from urllib.parse import quote_plus
 
 import ujson as json
 from acrossword import Document
-from personate.completions import default_generator_api
+from personate.completions import backend_from_dict
+from personate.memory.retention import RetentionPolicy
+from personate.utils.embeddings import configure_embedding_cache
 from personate.utils.logger import logger
 from personate.utils.username_generator import username_generator
 
@@ -110,6 +112,37 @@ class AgentFromJSON:
         agent.use_db(db_path)
         logger.debug(f"Using db {db_path}")
 
+        if data.get("layout", "relevance") == "stable_prefix":
+            agent.prompt.use_stable_prefix()
+
+        completion_backend = data.get("completion_backend", None)
+        if completion_backend:
+            agent.prompt.set_completion_backend(backend_from_dict(completion_backend))
+            logger.debug(f"Using completion backend {completion_backend}")
+
+        speculative_completions = data.get("speculative_completions", None)
+        if speculative_completions:
+            agent.prompt.set_speculation(speculative_completions)
+
+        streaming = data.get("streaming", None)
+        if streaming:
+            # true, or the number of seconds between edits.
+            agent.prompt.set_streaming(1.0 if streaming is True else float(streaming))
+
+        token_budget = data.get("token_budget", None)
+        if token_budget:
+            agent.prompt.set_token_budget(token_budget)
+
+        retention = data.get("retention", None)
+        if isinstance(retention, dict) and agent.memory:
+            agent.memory.use_retention(RetentionPolicy.from_dict(retention, home_dir))
+            logger.debug(f"Using retention policy {retention}")
+
+        embedding_cache_path = data.get("embedding_cache_path", None)
+        if embedding_cache_path:
+            configure_embedding_cache(path=embedding_cache_path)
+            logger.debug(f"Persisting embeddings to {embedding_cache_path}")
+
         loading_message = data.get(
             "loading_message",
             "https://i.pinimg.com/originals/f1/79/90/f179907b01caacdc35af6a0f27bc6616.gif",
@@ -5,15 +5,14 @@ from rapidfuzz import cpp_fuzz, cpp_process
 import discord
 import asyncio
 from personate.utils.logger import logger
-from acrossword import Ranker
+from personate.utils.embeddings import rank_texts
 
 def icon_to_url(icon: str) -> str:
     return f"https://img.icons8.com/dusk/512/000000/{icon}.png"
 
 async def get_top_icon(query: str) -> str:
     from personate.meta.icons.dusk import icons
-    ranker = Ranker()
-    top = await ranker.rank(texts=tuple(icons.split("\n")), query=query, top_k=1, model=ranker.default_model)
+    top = await rank_texts(texts=icons.split("\n"), query=query, top_k=1)
     return top[0]
 
 async def get_top_url(query: str) -> str:
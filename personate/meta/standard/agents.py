@@ -6,6 +6,7 @@ import ujson as json
 import uvloop
 from acrossword import Document, DocumentCollection, Ranker
 from personate.activators.activators import Activator
+from personate.activators.router import TopicRouter
 from asynchronise import Asynchronise
 from personate.decos.filter import Filter
 from personate.decos.translators.translator import (
@@ -15,6 +16,7 @@ from personate.decos.translators.translator import (
     Translator,
 )
 from personate.face.face import Face
+from personate.memory.ingest import Ingest
 from personate.memory.memory import Memory
 from sqlitedict import SqliteDict
 from personate.swarm.internal_message import InternalMessage
@@ -81,6 +83,7 @@ class Agent:
         self.face: Optional[Face] = None
         self.document_queue: List[Coroutine] = []
         self.memory: Optional[Memory] = None
+        self.ingest: Optional[Ingest] = None
         self.modifier = None
         self.improv_generator = None
         self.register_all()
@@ -178,8 +181,9 @@ class Agent:
         self.prompt.set_introduction(annotations.get("introduction", ""))
 
     def use_db(self, database_filename: str) -> None:
-        db = SqliteDict(database_filename, autocommit=True)
+        db = SqliteDict(database_filename, autocommit=True, journal_mode="WAL")
         self.memory = Memory(db)
+        self.ingest = Ingest(self.memory, ignore_names=[self.name])
         self.prompt.set_memory(self.memory)
 
     def add_knowledge(
@@ -233,8 +237,15 @@ class Agent:
 
     async def start(self):
         # tasks: List[Union[Coroutine, asyncio.Future]] = []
-        await self.assemble_documents()
-        await self.bot.start(self.token)
+        try:
+            await self.assemble_documents()
+            await self.bot.start(self.token)
+        finally:
+            await self.close_backends()
+
+    async def close_backends(self):
+        """Closes the completion backend's connections while their event loop is still running. run() starts a new loop every 400 seconds, and connections left on the old one would leak."""
+        await self.prompt.close_backend()
 
         # asyncio.gather(*tasks)
 
@@ -250,13 +261,25 @@ class Agent:
     @classmethod
     async def start_all(cls, bot: Optional[discord.Bot] = None, token: Optional[str] = None):
         instances = cls.__instances__
+        cls.route_topics(instances)
         if bot and token:
-            await asyncio.gather(*[instance.assemble_documents() for instance in instances])
-            await bot.start(token)
+            try:
+                await asyncio.gather(*[instance.assemble_documents() for instance in instances])
+                await bot.start(token)
+            finally:
+                await asyncio.gather(*[instance.close_backends() for instance in instances])
             return
         else:
             await asyncio.gather(*[instance.start() for instance in instances])
     
+    @classmethod
+    def route_topics(cls, instances: List["Agent"]) -> TopicRouter:
+        """Makes the on_topic activators of every Agent share one TopicRouter, so each message is embedded and scored once no matter how many Agents are listening."""
+        router = TopicRouter()
+        for instance in instances:
+            router.attach(instance.activator)
+        return router
+
     @classmethod
     def run_all(cls, bot: Optional[discord.Bot] = None, token: Optional[str] = None):
         instances = cls.__instances__
@@ -273,6 +296,21 @@ class Agent:
         self.document_collection.add_document(doc)
 
     def register_listeners(self):
+        @self.bot.listen("on_message")
+        async def ingest_messages(message: discord.Message):
+            if self.ingest:
+                self.ingest.observe(message)
+
+        @self.bot.listen("on_message_edit")
+        async def ingest_edited_messages(before: discord.Message, after: discord.Message):
+            if self.ingest and after:
+                self.ingest.observe(after)
+
+        @self.bot.listen("on_disconnect")
+        async def mark_history_stale():
+            if self.ingest:
+                self.ingest.mark_stale()
+
         @self.bot.listen("on_message")
         @self.activator.check(inputs=True, keyword="message")
         async def receive_messages(message: discord.Message):
@@ -287,6 +325,8 @@ class Agent:
         @self.bot.listen("on_connect")
         async def register_cog():
             logger.debug(f"{self.name} is ready.")
+            if self.memory:
+                self.memory.start_retention()
             if not self.modifier:
                 from personate.meta.inbuilt_commands import make_agent_modifier
                 self.modifier = make_agent_modifier(self.bot, self, self.agent_dir)
@@ -311,9 +351,12 @@ class Agent:
                 or not self.memory
             ):
                 return
-            agent_message: InternalMessage = self.memory.db[agent_message_id]
-            user_message_id = agent_message.reply_to
-            user_message: InternalMessage = self.memory.db[user_message_id]
+            agent_message = self.memory.get_message(agent_message_id)
+            if not agent_message:
+                return
+            user_message = self.memory.get_message(agent_message.reply_to)
+            if not user_message:
+                return
             interaction = str(user_message) + "\n" + str(agent_message)
             logger.debug(
                 f"{self.name} received positive feedback from this interaction: {interaction}"
@@ -333,11 +376,19 @@ class Agent:
             or not self.face or not self.memory
         ):
             return
-        asyncio.create_task(add_replies_to_memory(self.memory, external_message_user, self.name))
-        # Retrieves the reply-chain, if there is one.
+        # Only fetches history if this channel has a gap in it, otherwise everything is already in memory.
+        backfill = asyncio.create_task(
+            self.ingest.catch_up(external_message_user.channel)
+            if self.ingest
+            else add_replies_to_memory(self.memory, external_message_user, self.name)
+        )
         external_message_agent = await self.face.send_loading(
             external_message_user.channel
         )
+        try:
+            await backfill
+        except discord.HTTPException:
+            logger.warning("Couldn't fetch the channel's history, carrying on with what's in memory")
         await self.prompt.translate_message_pair(
             external_message_agent=external_message_agent,
             external_message_user=external_message_user,
@@ -347,16 +398,5 @@ class Agent:
         self.register_listeners()
 
 async def add_replies_to_memory(memory: Memory, message: discord.Message, name: str):
-    last_20_messages = await message.channel.history(limit=10).flatten()
-    for msg in last_20_messages:
-        internal_msg = InternalMessage.from_discord_message(msg)
-        try:
-            reply_to = int(str(msg.embeds[0].footer.text))
-            internal_msg.reply_to = reply_to
-            logger.debug("I found a message by a Personate chatbot and added a reply to it")
-        except:
-            pass
-        if not msg.id in memory.db.keys() and msg.author.name != name:
-            memory.db[msg.id] = internal_msg
-        else:
-            logger.debug(f"I already have a message with id {internal_msg.id}")
+    """Stores the last few messages of the channel. Agents don't need this any more, their Ingest keeps Memory up to date as messages arrive."""
+    await Ingest(memory, ignore_names=[name]).catch_up(message.channel)
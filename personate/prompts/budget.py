@@ -0,0 +1,125 @@
+from functools import lru_cache
+from typing import Dict, List, Sequence
+import re
+
+from personate.utils.logger import logger
+
+logger.disable(__name__)
+
+# Roughly how a BPE / SentencePiece tokenizer cuts text up: runs of letters (long words cost more than one
+# token), single digits, and single punctuation marks. It overestimates a little for plain English, which is
+# the safe side to be wrong on.
+PIECES = re.compile(r"[^\W\d_]+|\d|[^\w\s]")
+LETTERS_PER_TOKEN = 6
+
+
+def piece_cost(piece: str) -> int:
+    return 1 + (len(piece) - 1) // LETTERS_PER_TOKEN
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """An approximate token count that doesn't need the model's tokenizer. Cached, since the static parts of the prompt get counted on every turn."""
+    return sum(piece_cost(piece) for piece in PIECES.findall(text))
+
+
+def truncate_tokens(text: str, tokens: int, keep: str = "head") -> str:
+    """Cuts text down to about `tokens` tokens, keeping either its start ("head") or its end ("tail")."""
+    if tokens <= 0:
+        return ""
+    pieces = list(PIECES.finditer(text))
+    if keep == "tail":
+        pieces.reverse()
+    used = 0
+    cut = None
+    for piece in pieces:
+        used += piece_cost(piece.group())
+        if used > tokens:
+            cut = piece
+            break
+    if cut is None:
+        return text
+    if keep == "tail":
+        return text[cut.end() :].lstrip()
+    return text[: cut.start()].rstrip()
+
+
+class Section:
+    """
+    Part of a prompt competing for space.
+        items: what goes in it, in prompt order.
+        priority: lower goes first. Sections that come later get whatever is left.
+        keep: which end of the items matters most. "head" keeps the first ones and drops from the end, "tail" keeps the last ones (the newest lines of a conversation, the best-ranked examples) and drops from the start.
+        truncate: if not even the first item fits, cut it down to fit instead of leaving the section empty. Later items are only ever kept whole, so a conversation never starts halfway through a line.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        items: Sequence[str],
+        priority: int,
+        keep: str = "head",
+        truncate: bool = False,
+    ) -> None:
+        self.name = name
+        self.items = [item for item in items if item]
+        self.priority = priority
+        self.keep = keep
+        self.truncate = truncate
+
+
+class TokenBudget:
+    """
+    Shares out a fixed number of prompt tokens between the sections of a prompt, most important first. Whatever doesn't fit is dropped (or truncated, for sections that allow it), so the prompt never overflows the model's context and, once there's enough to fill it, is always about the same size.
+
+        budget = TokenBudget(total=2048, reserve=250)
+        budget.allocate([
+            Section("introduction", [intro], priority=0, truncate=True),
+            Section("conversation", lines, priority=1, keep="tail", truncate=True),
+            Section("examples", examples, priority=2, keep="tail"),
+        ])
+        # {'introduction': [...], 'conversation': [...], 'examples': [...]}
+
+    `reserve` is held back for the completion. budget.usage has the tokens each section got last time.
+    """
+
+    def __init__(self, total: int = 2048, reserve: int = 250) -> None:
+        self.total = total
+        self.reserve = reserve
+        self.usage: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+
+    @property
+    def available(self) -> int:
+        return self.total - self.reserve
+
+    def allocate(self, sections: Sequence[Section]) -> Dict[str, List[str]]:
+        remaining = self.available
+        allocation: Dict[str, List[str]] = {}
+        self.usage = {}
+        self.dropped = {}
+        for section in sorted(sections, key=lambda s: s.priority):
+            items = section.items if section.keep == "head" else section.items[::-1]
+            chosen: List[str] = []
+            used = 0
+            for item in items:
+                # Every item ends up on its own line.
+                cost = count_tokens(item) + 1
+                if cost <= remaining - used:
+                    chosen.append(item)
+                    used += cost
+                    continue
+                if section.truncate and not chosen:
+                    truncated = truncate_tokens(item, remaining - used - 1, section.keep)
+                    if truncated:
+                        chosen.append(truncated)
+                        used += count_tokens(truncated) + 1
+                break
+            if section.keep == "tail":
+                chosen.reverse()
+            remaining -= used
+            allocation[section.name] = chosen
+            self.usage[section.name] = used
+            self.dropped[section.name] = len(section.items) - len(chosen)
+        logger.debug(f"Token budget usage: {self.usage}, dropped: {self.dropped}")
+        return allocation
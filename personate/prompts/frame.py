@@ -1,5 +1,5 @@
 import asyncio
-import copy
+from collections import ChainMap
 from typing import (
     Any,
     Callable,
@@ -7,6 +7,7 @@ from typing import (
     Dict,
     Iterable,
     List,
+    MutableMapping,
     Optional,
     Sequence,
     Tuple,
@@ -15,7 +16,12 @@ from typing import (
 
 import discord
 from acrossword import Document, DocumentCollection
-from personate.completions import default_generator_api
+from personate.completions import (
+    CompletionBackend,
+    close_backend,
+    default_generator_api,
+    generator_api_for,
+)
 from personate.decos.filter import Filter, DefaultFilter
 from personate.decos.translators.translator import EmptyTranslator, Translator
 from personate.memory.memory import Memory
@@ -25,86 +31,199 @@ from personate.decos.translators.translator import (
 )
 from personate.swarm.internal_message import InternalMessage
 from personate.swarm.swarm import Swarm
+from personate.utils.embeddings import TurnEmbeddings, embeddings_for_turn
 from personate.utils.logger import logger
 
+from personate.prompts.budget import Section, TokenBudget
+from personate.prompts.prefix import PrefixRegistry
 from personate.prompts.semantic_list import SemanticList
+from personate.prompts.turns import Turn, TurnRegistry
 
 from asynchronise import Asynchronise
 
 
 class Frame:
-    def __init__(self, fields: List[Sequence[str]], generator_api: Callable):
-        self.fields = fields
-        self.field_values: dict[str, Union[str, List[str]]] = {}
+    """
+    A prompt template: an ordered list of (field name, default) pairs, rendered by joining the non-empty values with newlines.
+
+    The fields are frozen into a tuple that every clone shares. A clone's field_values is a ChainMap overlay on top of its parent's, so cloning copies nothing – the introduction, annotations and speech cue are read straight from the parent, and whatever a turn fills in (conversation, examples, sources, API result) only lands in the clone's own layer.
+    """
+
+    def __init__(self, fields: Sequence[Sequence[str]], generator_api: Callable):
+        self.fields: Tuple[Tuple[str, Any], ...] = tuple(
+            (field[0], field[1]) for field in fields
+        )
+        self.field_values: MutableMapping[str, Union[str, List[str]]] = {}
         # A list of field-names and their default values if unspecified.
         # self.template = template
         # A string containing the template to be used for this frame.
         self.filters = []
         # A list of filters to be applied to the outputs.
         self.generator_api = generator_api
+        # How many of the leading fields make up the static prefix, and where to record it. See AgentFrame.use_stable_prefix.
+        self.prefix_length = 0
+        self.prefixes: Optional[PrefixRegistry] = None
+        # How many times to ask for a completion before giving up on the filters, and how many of those to ask for at once.
+        self.attempts = 5
+        self.speculation = 1
+
+    def render(self) -> Tuple[str, str]:
+        """Returns the prompt split into its static prefix and the rest."""
+        values = self.field_values
+        prefix = []
+        tail = []
+        for position, (name, default) in enumerate(self.fields):
+            val = values.get(name, default)
+            if len(val) == 0:
+                continue
+            parts = prefix if position < self.prefix_length else tail
+            parts.append(val if isinstance(val, str) else "\n".join(val))
+        return "\n".join(prefix), "\n".join(tail)
 
     async def as_string(self) -> str:
         logger.debug(self.fields)
         logger.debug(self.field_values)
-        final_string = ""
-        for field in self.fields:
-            try:
-                val = self.field_values[field[0]]
-            except KeyError:
-                val = field[1]
-            if len(val) == 0:
-                continue
-            if isinstance(val, str):
-                final_string += val
-            elif isinstance(val, list):
-                final_string += "\n".join(val)
-            final_string += "\n"
-        return final_string[:-1]
+        return "\n".join(part for part in self.render() if part)
 
     def clone(self):
-        new_frame = Frame(
-            fields=copy.deepcopy(self.fields), generator_api=self.generator_api
-        )
-        new_frame.field_values = copy.deepcopy(self.field_values)
+        new_frame = Frame.__new__(Frame)
+        new_frame.fields = self.fields
+        new_frame.field_values = ChainMap({}, self.field_values)
         new_frame.filters = self.filters
+        new_frame.generator_api = self.generator_api
+        new_frame.prefix_length = self.prefix_length
+        new_frame.prefixes = self.prefixes
+        new_frame.attempts = self.attempts
+        new_frame.speculation = self.speculation
         return new_frame
 
+    async def rejected(self, completion: str, prompt: str) -> bool:
+        should_reject = await asyncio.gather(
+            *[
+                f.validate(
+                    response=completion,
+                    final_prompt=prompt,
+                )
+                for f in self.filters
+            ]
+        )
+        logger.debug(f"The Filters and their results were:")
+        for f, b in zip(self.filters, should_reject):
+            logger.debug(f.__class__.__name__, b)
+        return any(should_reject)
+
     async def complete(self) -> str:
-        prompt = await self.as_string()
+        prefix, tail = self.render()
+        prompt = "\n".join(part for part in (prefix, tail) if part)
+        generator_kwargs = {}
+        if self.prefixes is not None and prefix:
+            prefix_key = self.prefixes.observe(prefix)
+            if getattr(self.generator_api, "accepts_prefix_key", False):
+                generator_kwargs["prefix_key"] = prefix_key
+        if self.speculation > 1:
+            return await self.complete_speculatively(prompt, generator_kwargs)
         completion = None
-        for i in range(5):
-            completion = await self.generator_api(prompt=prompt)
-            should_reject = await asyncio.gather(
-                *[
-                    f.validate(
-                        response=completion,
-                        final_prompt=prompt,
-                    )
-                    for f in self.filters
-                ]
-            )
-            logger.debug(f"The Filters and their results were:")
-            for f, b in zip(self.filters, should_reject):
-                logger.debug(f.__class__.__name__, b)
-            if not any(should_reject):
+        for i in range(self.attempts):
+            completion = await self.generator_api(prompt=prompt, **generator_kwargs)
+            if not await self.rejected(completion, prompt):
                 break
         if completion:
             return completion
         else:
             raise Exception("No completion found.")
 
+    async def complete_streaming(
+        self,
+        on_partial: Callable[[str], Coroutine[Any, Any, None]],
+        on_rejected: Optional[Callable[[], Coroutine[Any, Any, None]]] = None,
+    ) -> str:
+        """
+        Streams the completion from the generator api's `stream` (default_generator_api has one), calling on_partial with the text so far. Only whole words are passed on, and only once they've got past every Filter's validate_partial, so a slur is caught before anyone sees it and the attempt is abandoned straight away instead of after the whole completion has arrived. Falls back to complete() if the generator api can't stream.
+
+        The other filters can only judge the whole completion, so they run once the stream ends, and by then the text has been shown. If an attempt that's been shown is rejected, on_rejected is called so the caller can take it back before the next one.
+        """
+        stream_api = getattr(self.generator_api, "stream", None)
+        if stream_api is None:
+            return await self.complete()
+        prefix, tail = self.render()
+        prompt = "\n".join(part for part in (prefix, tail) if part)
+        generator_kwargs = {}
+        if self.prefixes is not None and prefix:
+            prefix_key = self.prefixes.observe(prefix)
+            if getattr(self.generator_api, "accepts_prefix_key", False):
+                generator_kwargs["prefix_key"] = prefix_key
+        completion = ""
+        for i in range(self.attempts):
+            completion = ""
+            shown = ""
+            abandoned = False
+            chunks = stream_api(prompt=prompt, **generator_kwargs)
+            try:
+                async for chunk in chunks:
+                    completion += chunk
+                    # The last word might not be finished yet.
+                    whole_words = completion[: max(completion.rfind(" "), completion.rfind("\n"), 0)]
+                    if len(whole_words) <= len(shown):
+                        continue
+                    if any(f.validate_partial(whole_words) for f in self.filters):
+                        logger.debug(f"Abandoned a streamed completion: {whole_words!r}")
+                        abandoned = True
+                        break
+                    shown = whole_words
+                    await on_partial(shown)
+            finally:
+                await chunks.aclose()
+            if not abandoned and not await self.rejected(completion, prompt):
+                break
+            if shown and on_rejected is not None:
+                await on_rejected()
+        if completion:
+            return completion
+        else:
+            raise Exception("No completion found.")
 
-import random
+    async def complete_speculatively(self, prompt: str, generator_kwargs: dict) -> str:
+        """
+        Asks for `speculation` completions at once instead of one after the other, and returns the first that gets past the filters. If the generator api has a `candidates(prompt, n)` method (every CompletionBackend and default_generator_api do), that's a single request for n completions; otherwise it's n concurrent requests, each validated as soon as it arrives, with the stragglers cancelled once one passes. So a rejected completion costs about one call's latency instead of a whole extra round trip, at the price of up to `speculation` times the usage.
+        """
+        candidates_api = getattr(self.generator_api, "candidates", None)
+        completion = None
+        rounds = -(-self.attempts // self.speculation)
+        for _ in range(rounds):
+            if candidates_api is not None:
+                completions = await candidates_api(
+                    prompt=prompt, n=self.speculation, **generator_kwargs
+                )
+                rejections = await asyncio.gather(
+                    *[self.rejected(c, prompt) for c in completions]
+                )
+                for completion, rejected in zip(completions, rejections):
+                    if not rejected:
+                        return completion
+                continue
+            tasks = [
+                asyncio.ensure_future(self.generator_api(prompt=prompt, **generator_kwargs))
+                for _ in range(self.speculation)
+            ]
+            try:
+                for next_completion in asyncio.as_completed(tasks):
+                    try:
+                        completion = await next_completion
+                    except Exception as e:
+                        logger.warning(f"A speculative completion failed: {e!r}")
+                        continue
+                    if not await self.rejected(completion, prompt):
+                        return completion
+            finally:
+                for task in tasks:
+                    task.cancel()
+        if completion:
+            return completion
+        else:
+            raise Exception("No completion found.")
 
 
-class Turn:
-    def __init__(self, id: int, **kwargs):
-        self.id = id
-        self.internal_message_agent: Optional[InternalMessage] = None
-        self.external_message_agent: Optional[discord.Message] = None
-        self.internal_message_user: Optional[InternalMessage] = None
-        self.external_message_user: Optional[discord.Message] = None
-        self.__dict__.update(kwargs)
+import random
 
 
 class AgentFrame:
@@ -132,9 +251,14 @@ class AgentFrame:
         self.examples = SemanticList()
         self.frame.filters = [DefaultFilter()]
         self.memory: Optional[Memory] = None
-        self.turns: Dict[int, Turn] = {}
+        self.turns = TurnRegistry()
         self.document_collection: Optional[DocumentCollection] = None
         self.max_characters: int = 1000
+        self.budget: Optional[TokenBudget] = TokenBudget()
+        # "relevance" reorders the examples for every message, "stable_prefix" pins them. See use_stable_prefix.
+        self.layout = "relevance"
+        # Seconds between edits of the loading message while a completion streams in, or None to wait for the whole thing.
+        self.streaming: Optional[float] = None
         self.__dict__.update(kwargs)
         self.asyncer = Asynchronise(name="agent frame asyncer")
         self.register_listeners()
@@ -146,6 +270,7 @@ class AgentFrame:
 
     def set_memory(self, mem: Memory):
         self.memory = mem
+        self.turns.memory = mem
 
     def set_pre_translator(self, translator: Translator):
         self.pre_translator = translator
@@ -156,6 +281,83 @@ class AgentFrame:
     def set_document_collection(self, collection: DocumentCollection):
         self.document_collection = collection
 
+    def set_speculation(self, candidates: int):
+        """Ask for this many completions at once and use the first one the filters accept. See Frame.complete_speculatively."""
+        self.frame.speculation = candidates
+
+    def set_completion_backend(self, backend: CompletionBackend):
+        """Use this backend for this agent (and its Swarm) only, instead of the shared one from get_backend."""
+        self.frame.generator_api = generator_api_for(backend)
+        self.swarm.backend = backend
+
+    async def close_backend(self):
+        backend = getattr(self.frame.generator_api, "backend", None)
+        if backend is not None:
+            await backend.close()
+        else:
+            await close_backend()
+
+    def set_streaming(self, interval: Optional[float] = 1.0):
+        """Show the completion in the loading message as it's generated, editing it at most every `interval` seconds. See Frame.complete_streaming."""
+        self.streaming = interval
+
+    async def complete_frame(self, frame: Frame, loading_message: Optional[discord.Message]) -> str:
+        if self.streaming is None or loading_message is None or not self.parent.face:
+            return await frame.complete()
+        post_translator = getattr(self, "post_translator", None)
+        if post_translator is not None and post_translator.rewrites():
+            # The partial text would skip whatever the translators do to it (spoilering, translating), so don't show it.
+            logger.debug("Not streaming, since a post-translator changes the text of the reply.")
+            return await frame.complete()
+        editor = self.parent.face.streaming_editor(loading_message, self.streaming)
+        try:
+            return await frame.complete_streaming(editor, editor.reset)
+        finally:
+            await editor.close()
+
+    def set_token_budget(self, total: int, reserve: int = 250):
+        self.budget = TokenBudget(total=total, reserve=reserve)
+
+    def fit_to_budget(self, frame: Frame) -> None:
+        """Drops or truncates whatever doesn't fit in the token budget, least important first: examples, then sources, then the API result, then the oldest lines of the conversation. The annotations, the speech cue and the newest line of the conversation (the message being replied to) always stay, even if that means cutting down the introduction."""
+        if not self.budget:
+            return
+        defaults = dict(frame.fields)
+
+        def items(name: str) -> List[str]:
+            value = frame.field_values.get(name, defaults[name])
+            if isinstance(value, str):
+                return value.split("\n") if name == "current_conversation" else [value]
+            return [str(v) for v in value]
+
+        conversation = [line for line in items("current_conversation") if line]
+        sections = [
+            Section("speech_cue", items("speech_cue"), priority=0),
+            Section("latest_message", conversation[-1:], priority=0, truncate=True),
+            Section("pre_conversation_annotation", items("pre_conversation_annotation"), priority=0),
+            Section("pre_response_annotation", items("pre_response_annotation"), priority=0),
+            Section("introduction", items("introduction"), priority=1, truncate=True),
+            # Pinned examples are part of the static prefix, so they go before anything that changes per message.
+            Section("examples", items("examples"), priority=1 if self.layout == "stable_prefix" else 5, keep="tail"),
+            Section("current_conversation", conversation[:-1], priority=2, keep="tail", truncate=True),
+            Section("api_result", items("api_result"), priority=3, truncate=True),
+            Section("reading_cue", items("reading_cue"), priority=4, truncate=True),
+        ]
+        allocation = self.budget.allocate(sections)
+        allocation["current_conversation"] += allocation.pop("latest_message")
+        sections = [section for section in sections if section.name != "latest_message"]
+        for section in sections:
+            chosen = allocation[section.name]
+            if section.name == "current_conversation":
+                if chosen == conversation:
+                    continue
+            elif chosen == section.items:
+                continue
+            if section.name == "examples":
+                frame.field_values[section.name] = chosen
+            else:
+                frame.field_values[section.name] = "\n".join(chosen)
+
     # def add_reading_cue(self, sources: str):
     # self.frame.field_values["reading_cue"] = f'(Sources: "{sources}")'
 
@@ -175,6 +377,21 @@ class AgentFrame:
 
     def set_examples(self, examples: List[Any]):
         self.examples = SemanticList([str(c) for c in examples if len(str(c)) > 0])
+        if self.layout == "stable_prefix":
+            self.use_stable_prefix()
+
+    def use_stable_prefix(self, examples: Optional[List[str]] = None):
+        """
+        Lays the prompt out so that it starts with the same text every time: the introduction, a pinned set of examples (the first `examples.maximum` unless you pass your own) and the pre-conversation annotation. Only the conversation, sources and API result after that change from message to message, so a backend that caches prompt prefixes only has to process the tail. You lose the per-message reordering of examples in exchange.
+        """
+        self.layout = "stable_prefix"
+        pinned = examples if examples is not None else self.examples[: self.examples.maximum]
+        self.frame.field_values["examples"] = [str(e) for e in pinned]
+        self.frame.prefix_length = [name for name, _ in self.frame.fields].index(
+            "pre_conversation_annotation"
+        ) + 1
+        if self.frame.prefixes is None:
+            self.frame.prefixes = PrefixRegistry()
 
     def set_introduction(self, introduction: str):
         self.frame.field_values["introduction"] = introduction
@@ -208,7 +425,8 @@ class AgentFrame:
             internal_message_user=internal_message_user,
             internal_message_agent=internal_message_agent,
         )
-        self.turns[turn.id] = turn
+        self.turns.add(turn)
+        embeddings = embeddings_for_turn(turn.id)
 
         if not self.memory:
             raise Exception("No memory set.")
@@ -230,8 +448,8 @@ class AgentFrame:
             processed_user_message=turn.internal_message_user,
             original_user_message=turn.external_message_user,
         )
-        if not external_message_user.id in self.memory.db.keys():
-            self.memory.insert_message(external_message_user.id, turn.internal_message_user)
+        # Replaces the raw copy Ingest stored when the message arrived.
+        self.memory.insert_message(external_message_user.id, turn.internal_message_user)
         # else:
         # turn.internal_message_user = self.memory.db[external_message_user.id]
 
@@ -247,12 +465,16 @@ class AgentFrame:
             ]
         )
 
-        frame.field_values["examples"] = await self.examples.reordered(
-            query=frame.field_values["current_conversation"][-120:]
-        )
+        if self.layout != "stable_prefix":
+            frame.field_values["examples"] = await self.examples.reordered(
+                query=frame.field_values["current_conversation"][-120:],
+                embeddings=embeddings,
+            )
 
         api_result_task = asyncio.create_task(
-            self.swarm.solve(turn.internal_message_user.internal_content)
+            self.swarm.solve(
+                turn.internal_message_user.internal_content, embeddings=embeddings
+            )
         )
 
         if self.document_collection and len(self.document_collection.documents) > 0:
@@ -270,7 +492,8 @@ class AgentFrame:
         if api_result:
             frame.field_values["api_result"] = f'(API result: "{api_result}")'
 
-        completion = await frame.complete()
+        self.fit_to_budget(frame)
+        completion = await self.complete_frame(frame, external_message_agent)
         turn.internal_message_agent.reply_to = turn.external_message_user.id
         turn.internal_message_agent.internal_content = completion
         turn.internal_message_agent.external_content = completion
@@ -280,10 +503,12 @@ class AgentFrame:
             agent_message=turn.internal_message_agent,
             user_message=turn.external_message_user,
             processed_user_message=turn.internal_message_user,
+            embeddings=embeddings,
         )
         self.memory.insert_message(
             external_message_agent.id, turn.internal_message_agent
         )
+        self.turns.pop(turn.id)
         return turn.internal_message_agent
 
     async def translate_message_pair(
@@ -298,9 +523,11 @@ class AgentFrame:
         ):
             yield external_message_user, "external_message_user"
             yield external_message_agent, "external_message_agent"
+            yield embeddings_for_turn(external_message_user.id), "turn_embeddings"
             if not self.memory:
                 return
-            if not external_message_user.id in self.memory.db.keys():
+            stored_message_user = self.memory.get_message(external_message_user.id)
+            if stored_message_user is None:
                 internal_message_user = InternalMessage.from_discord_message(
                     external_message_user
                 )
@@ -312,7 +539,7 @@ class AgentFrame:
                     pass
                 logger.debug(f"User message was not in db: {internal_message_user}")
             else:
-                internal_message_user = self.memory.db[external_message_user.id]
+                internal_message_user = stored_message_user
                 logger.debug(f"User message was in db: {internal_message_user}")
             internal_message_agent = InternalMessage.from_discord_message(
                 external_message_agent
@@ -322,6 +549,15 @@ class AgentFrame:
                 original_user_message=external_message_user,
             )
             self.memory.insert_message(external_message_user.id, internal_message_user)
+            self.turns.add(
+                Turn(
+                    id=external_message_user.id,
+                    external_message_user=external_message_user,
+                    external_message_agent=external_message_agent,
+                    internal_message_user=internal_message_user,
+                    internal_message_agent=internal_message_agent,
+                )
+            )
             yield internal_message_user, "internal_message_user"
             yield internal_message_agent, "internal_message_agent"
 
@@ -346,10 +582,21 @@ class AgentFrame:
 
         @self.asyncer.send
         @self.asyncer.collect(
-            {"internal_message_user": (InternalMessage, "internal_message_user", None)}
+            {
+                "internal_message_user": (
+                    InternalMessage,
+                    "internal_message_user",
+                    None,
+                ),
+                "embeddings": (TurnEmbeddings, "turn_embeddings", None),
+            }
         )
-        async def get_api_result(internal_message_user: InternalMessage):
-            api_result = await self.swarm.solve(internal_message_user.internal_content)
+        async def get_api_result(
+            internal_message_user: InternalMessage, embeddings: TurnEmbeddings
+        ):
+            api_result = await self.swarm.solve(
+                internal_message_user.internal_content, embeddings=embeddings
+            )
             yield api_result, "api_result"
 
         @self.asyncer.send
@@ -372,11 +619,15 @@ class AgentFrame:
         @self.asyncer.collect(
             {
                 "current_conversation": (str, "current_conversation", None),
+                "embeddings": (TurnEmbeddings, "turn_embeddings", None),
             }
         )
-        async def get_examples(current_conversation: str):
+        async def get_examples(current_conversation: str, embeddings: TurnEmbeddings):
+            if self.layout == "stable_prefix":
+                yield None, "examples"
+                return
             yield await self.examples.reordered(
-                query=current_conversation[-120:]
+                query=current_conversation[-120:], embeddings=embeddings
             ), "examples"
 
         @self.asyncer.send
@@ -401,12 +652,22 @@ class AgentFrame:
                 ] = f'(Source: "{reading_cue}")'
             if examples:
                 frame.field_values["examples"] = examples
+            self.fit_to_budget(frame)
             yield frame, "frame"
 
         @self.asyncer.send
-        @self.asyncer.collect({"frame": (Frame, "frame", None)})
-        async def get_completion(frame: Frame):
-            completion = await frame.complete()
+        @self.asyncer.collect(
+            {
+                "frame": (Frame, "frame", None),
+                "external_message_agent": (
+                    discord.Message,
+                    "external_message_agent",
+                    None,
+                ),
+            }
+        )
+        async def get_completion(frame: Frame, external_message_agent: discord.Message):
+            completion = await self.complete_frame(frame, external_message_agent)
             yield completion, "completion"
 
         @self.asyncer.send
@@ -423,12 +684,14 @@ class AgentFrame:
                     "external_message_user",
                     None,
                 ),
+                "embeddings": (TurnEmbeddings, "turn_embeddings", None),
             }
         )
         async def post_translation(
             internal_message_agent: InternalMessage,
             completion: str,
             external_message_user: discord.Message,
+            embeddings: TurnEmbeddings,
         ):
             internal_message_agent.reply_to = external_message_user.id
             internal_message_agent.external_content = completion
@@ -439,6 +702,7 @@ class AgentFrame:
                 agent_message=internal_message_agent,
                 user_message=external_message_user,
                 processed_user_message=internal_message_agent,
+                embeddings=embeddings,
             )
             yield internal_message_agent, "internal_message_agent_complete"
             if not self.memory:
@@ -471,6 +735,7 @@ class AgentFrame:
             external_message_agent: discord.Message,
             external_message_user: discord.Message,
         ):
+            self.turns.pop(external_message_user.id)
             if self.parent.no_webhooks:
                 await self.parent.face.reply_and_delete(
                     internal_message_agent,
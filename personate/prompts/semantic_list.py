@@ -1,4 +1,6 @@
 from acrossword import Ranker
+from personate.utils.embeddings import TurnEmbeddings, rank_texts
+from typing import Optional
 
 
 class SemanticList(list):
@@ -14,13 +16,16 @@ class SemanticList(list):
     def set_ranker(self, ranker: Ranker) -> None:
         self.ranker = ranker
 
-    async def reordered(self, query: str) -> list:
+    async def reordered(
+        self, query: str, embeddings: Optional[TurnEmbeddings] = None
+    ) -> list:
         contents = [str(item) for item in self]
-        ranked = await self.ranker.rank(
-            texts=tuple(contents),
+        ranked = await rank_texts(
+            texts=contents,
             query=query,
-            top_k=999999,
+            top_k=len(contents),
             model=self.ranker.default_model,
+            embeddings=embeddings,
         )
         return list(reversed(ranked[: self.maximum]))
 
@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import discord
+from personate.memory.memory import Memory
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+class Turn:
+    def __init__(self, id: int, **kwargs):
+        self.id = id
+        self.internal_message_agent: Optional[InternalMessage] = None
+        self.external_message_agent: Optional[discord.Message] = None
+        self.internal_message_user: Optional[InternalMessage] = None
+        self.external_message_user: Optional[discord.Message] = None
+        self.__dict__.update(kwargs)
+
+
+class TurnRegistry:
+    """
+    Keeps the turns an AgentFrame is working on, keyed by the id of the user message. A Turn holds on to whole discord.Message objects (and through them the guild, channel and member caches), so this is bounded: turns are dropped once there are more than `maximum` of them, or once they're older than `ttl` seconds.
+
+    If a Memory is given, the internal messages of an evicted turn are written to it first (when they aren't there already), so dropping a turn never loses anything that was said.
+
+        agent.prompt.turns.stats()
+        # {'live': 14, 'created': 9031, 'expired': 8990, 'dropped': 27, 'spilled': 3, 'oldest': 41.2}
+    """
+
+    def __init__(
+        self, maximum: int = 256, ttl: float = 15 * 60, memory: Optional[Memory] = None
+    ) -> None:
+        self.maximum = maximum
+        self.ttl = ttl
+        self.memory = memory
+        self.turns: "OrderedDict[int, Tuple[float, Turn]]" = OrderedDict()
+        self.created = 0
+        self.expired = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def __contains__(self, turn_id: int) -> bool:
+        return self.get(turn_id) is not None
+
+    def __getitem__(self, turn_id: int) -> Turn:
+        turn = self.get(turn_id)
+        if turn is None:
+            raise KeyError(turn_id)
+        return turn
+
+    def __setitem__(self, turn_id: int, turn: Turn) -> None:
+        if turn_id in self.turns:
+            del self.turns[turn_id]
+        else:
+            self.created += 1
+        self.turns[turn_id] = (time.monotonic(), turn)
+        self.evict()
+
+    def add(self, turn: Turn) -> Turn:
+        self[turn.id] = turn
+        return turn
+
+    def get(self, turn_id: int) -> Optional[Turn]:
+        entry = self.turns.get(turn_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            self.remove(turn_id)
+            self.expired += 1
+            return None
+        return entry[1]
+
+    def pop(self, turn_id: int) -> Optional[Turn]:
+        entry = self.turns.pop(turn_id, None)
+        return entry[1] if entry else None
+
+    def remove(self, turn_id: int) -> None:
+        turn = self.pop(turn_id)
+        if turn is not None:
+            self.spill(turn)
+
+    def evict(self) -> None:
+        # Oldest first, so we can stop at the first turn that's still fresh.
+        now = time.monotonic()
+        while self.turns:
+            turn_id, (created_at, _) = next(iter(self.turns.items()))
+            if now - created_at > self.ttl:
+                self.expired += 1
+            elif len(self.turns) > self.maximum:
+                self.dropped += 1
+            else:
+                break
+            self.remove(turn_id)
+
+    def spill(self, turn: Turn) -> None:
+        if not self.memory:
+            return
+        # The agent's message is only worth keeping once it has been filled in and knows what it replied to.
+        finished_agent_message = (
+            turn.internal_message_agent
+            if getattr(turn.internal_message_agent, "reply_to", 0)
+            else None
+        )
+        for internal_message in (turn.internal_message_user, finished_agent_message):
+            message_id = getattr(internal_message, "id", 0)
+            if message_id and not self.memory.has_message(message_id):
+                self.memory.insert_message(message_id, internal_message)  # type: ignore
+                self.spilled += 1
+                logger.debug(f"Saved message {message_id} from an evicted turn")
+
+    def stats(self) -> Dict[str, float]:
+        self.evict()
+        oldest = next(iter(self.turns.values()), None)
+        return {
+            "live": len(self.turns),
+            "created": self.created,
+            "expired": self.expired,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "oldest": time.monotonic() - oldest[0] if oldest else 0.0,
+        }
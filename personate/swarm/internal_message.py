@@ -1,9 +1,25 @@
 import discord
-from typing import Hashable
+from typing import Hashable, List, Optional, Union
 import typing
+import orjson
 import slugify
 
 
+def encode_embeds(embeds: Union[bytes, List[discord.Embed], None]) -> Optional[bytes]:
+    """Serialises embeds as JSON (via Embed.to_dict) rather than pickling them. Embeds that were never decoded are passed straight through."""
+    if not embeds:
+        return None
+    if isinstance(embeds, bytes):
+        return embeds
+    return orjson.dumps(
+        [embed.to_dict() for embed in embeds if isinstance(embed, discord.Embed)]
+    )
+
+
+def decode_embeds(data: bytes) -> List[discord.Embed]:
+    return [discord.Embed.from_dict(embed) for embed in orjson.loads(data)]
+
+
 class InternalMessage:
     """
     This class is used to represent a message in a conversation. Non-nested (i.e floats, ints, and strings) attributes are shallowly copied over from discord.Message objects, or can be constructed ex nihilo. Most importantly, they contain a "reply_to" attribute with the id of the message being replied to, and an internal_content attribute that represents how the message should be displayed to a Swarm/Agent.
@@ -58,7 +74,7 @@ class InternalMessage:
         "internal_content",
         "external_content",
         "channel_id",
-        "embeds",
+        "_embeds",
         "files",
         "author_id",
     )
@@ -73,6 +89,17 @@ class InternalMessage:
         self.embeds = []
         self.files = []
 
+    @property
+    def embeds(self) -> List[discord.Embed]:
+        # Messages loaded from Memory keep their embeds encoded until somebody actually asks for them.
+        if isinstance(self._embeds, bytes):
+            self._embeds = decode_embeds(self._embeds)
+        return self._embeds
+
+    @embeds.setter
+    def embeds(self, value: Union[bytes, List[discord.Embed]]) -> None:
+        self._embeds = value
+
     def display_as_irc(self) -> str:
         """
         Return the message as an IRC-style string.
@@ -1,15 +1,18 @@
-from typing import Dict, Callable, Any
+from typing import Dict, Callable, Any, Optional
 import ast
-from pyai21 import get
+from personate.completions import SWARM_SETTINGS, CompletionBackend, get_backend
 import inspect
 from personate.utils.logger import logger
 from personate.swarm.swarm_prompt import prompt
+from personate.utils.embeddings import TurnEmbeddings, rank_texts
 
 
 class Swarm:
     def __init__(self):
         self.abilities: Dict[str, Callable] = {}
         self.prompt = prompt
+        # None means the shared backend from get_backend.
+        self.backend: Optional[CompletionBackend] = None
 
     def use(self, func: Callable) -> Callable:
         """This inserts a function into self.abilities, with the key as the function's docstring, and the value as the function itself"""
@@ -39,21 +42,19 @@ class Swarm:
                     logger.debug(f"Registering {obj.__name__}")
                     self.use(obj)
 
-    async def solve(self, query: str) -> Any:
+    async def solve(
+        self, query: str, embeddings: Optional[TurnEmbeddings] = None
+    ) -> Any:
         """This uses ranker to evaluate which function is most suited to the query, calls it, and returns the result"""
         if not len(self.abilities.keys()) > 0:
             return
-        from acrossword import Ranker
-
-        ranker = Ranker()
-        top_function_docstring = await ranker.rank(
+        top_function_docstring = await rank_texts(
             query="A Python function that would be able to solve this question: "
             + query,
             top_k=1,
-            texts=tuple(self.abilities.keys()),
-            model=ranker.default_model,
-            return_none_if_below_threshold=True,
+            texts=list(self.abilities.keys()),
             threshold=0.1,
+            embeddings=embeddings,
         )
         if not top_function_docstring:
             return
@@ -92,8 +93,5 @@ class Swarm:
             .replace("{documentation}", top_function_docstring)
             .replace("{name}", func_name)
         )
-        args = await get(prompt=prompt, temp=0.55, stops=[")\n"], max=30)
-        if isinstance(args, str):
-            return args
-        else:
-            return args[0]
+        backend = self.backend or get_backend()
+        return (await backend.complete(prompt, **SWARM_SETTINGS))[0]
@@ -0,0 +1,258 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from acrossword import Ranker
+from sqlitedict import SqliteDict
+from personate.utils.logger import logger
+
+
+class EmbeddingCache:
+    """
+    A process-wide cache of sentence embeddings, keyed on (model, text). Most of the texts we rank against never change (topic sentences, CW labels, emoji labels, docstrings, examples, icon names), so they only ever need to be embedded once. Vectors are stored L2-normalised, which means cosine similarity is just a dot product.
+
+    Eviction is least-recently-used once there are more than `maximum` entries. If you give it a path, embeddings are also written to a SqliteDict so that they survive restarts.
+    """
+
+    def __init__(self, maximum: int = 50000, path: Optional[str] = None) -> None:
+        self.maximum = maximum
+        self.entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self.disk: Optional[SqliteDict] = None
+        self.hits = 0
+        self.misses = 0
+        self._ranker: Optional[Ranker] = None
+        if path:
+            self.persist_to(path)
+
+    @property
+    def ranker(self) -> Ranker:
+        if self._ranker is None:
+            self._ranker = Ranker()
+        return self._ranker
+
+    @property
+    def default_model(self) -> str:
+        return self.ranker.default_model
+
+    def persist_to(self, path: str) -> None:
+        self.disk = SqliteDict(path, tablename="embeddings", autocommit=True)
+
+    def _disk_key(self, key: Tuple[str, str]) -> str:
+        return f"{key[0]}\x00{key[1]}"
+
+    def get(self, key: Tuple[str, str]) -> Optional[np.ndarray]:
+        vector = self.entries.get(key)
+        if vector is not None:
+            self.entries.move_to_end(key)
+            return vector
+        if self.disk is not None:
+            stored = self.disk.get(self._disk_key(key))
+            if stored is not None:
+                vector = np.frombuffer(stored, dtype=np.float32)
+                self._remember(key, vector)
+                return vector
+        return None
+
+    def put(self, key: Tuple[str, str], vector: np.ndarray) -> np.ndarray:
+        vector = np.ascontiguousarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        self._remember(key, vector)
+        if self.disk is not None:
+            self.disk[self._disk_key(key)] = vector.tobytes()
+        return vector
+
+    def _remember(self, key: Tuple[str, str], vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maximum:
+            self.entries.popitem(last=False)
+
+    async def _encode(self, texts: Tuple[str, ...], model: str) -> Sequence:
+        return await self.ranker.convert(model_name=model, sentences=texts)
+
+    async def embed(
+        self, texts: Sequence[str], model: Optional[str] = None
+    ) -> np.ndarray:
+        """Returns a (len(texts), dimensions) matrix of normalised embeddings, only sending the texts we haven't seen before to the model."""
+        model = model or self.default_model
+        found: Dict[str, np.ndarray] = {}
+        missing: List[str] = []
+        for text in dict.fromkeys(texts):
+            vector = self.get((model, text))
+            if vector is None:
+                missing.append(text)
+            else:
+                found[text] = vector
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            logger.debug(f"Embedding {len(missing)} uncached texts with {model}")
+            vectors = await self._encode(tuple(missing), model)
+            for text, vector in zip(missing, vectors):
+                found[text] = self.put((model, text), vector)
+        return np.stack([found[text] for text in texts])
+
+    async def embed_one(self, text: str, model: Optional[str] = None) -> np.ndarray:
+        return (await self.embed([text], model=model))[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Returns the shared EmbeddingCache, creating it the first time it's needed."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def configure_embedding_cache(
+    maximum: Optional[int] = None, path: Optional[str] = None
+) -> EmbeddingCache:
+    cache = get_embedding_cache()
+    if maximum is not None:
+        cache.maximum = maximum
+    if path:
+        cache.persist_to(path)
+    return cache
+
+
+class TurnEmbeddings:
+    """
+    Embeds each distinct query string at most once for the lifetime of a turn, handing out the same in-flight task to everyone who asks for it at the same time instead of racing to fill the cache. Only identical strings are shared, which in practice means:
+        - the user's message, across the on_topic checks of every Agent that isn't behind a TopicRouter
+        - the agent's completion, between the CW tagger and the emoji translator
+    Everything else asks for its own string (Swarm ranks its abilities against "A Python function that would be able to solve this question: ..." rather than the message itself, and the examples are reordered by the end of the conversation), so for those it only saves repeat lookups within the turn.
+    """
+
+    def __init__(self, model: Optional[str] = None) -> None:
+        self.model = model
+        self.vectors: Dict[str, "asyncio.Future[np.ndarray]"] = {}
+
+    async def get(self, text: str) -> np.ndarray:
+        if text not in self.vectors:
+            self.vectors[text] = asyncio.ensure_future(
+                get_embedding_cache().embed_one(text, model=self.model)
+            )
+        try:
+            return await self.vectors[text]
+        except Exception:
+            self.vectors.pop(text, None)
+            raise
+
+
+async def query_vector(
+    query: str,
+    model: Optional[str] = None,
+    embeddings: Optional[TurnEmbeddings] = None,
+) -> np.ndarray:
+    """Embeds a query through the turn's TurnEmbeddings when it uses the same model, or straight through the cache otherwise."""
+    cache = get_embedding_cache()
+    if embeddings is not None and (embeddings.model or cache.default_model) == (
+        model or cache.default_model
+    ):
+        return await embeddings.get(query)
+    return await cache.embed_one(query, model=model)
+
+
+_turn_embeddings: "OrderedDict[int, TurnEmbeddings]" = OrderedDict()
+
+
+def embeddings_for_turn(turn_id: int, maximum: int = 256) -> TurnEmbeddings:
+    """Returns the TurnEmbeddings for a message id, so that everything handling the same message (every Agent's activators, then the reply pipeline) shares one set of query vectors. Only the most recent turns are kept around."""
+    embeddings = _turn_embeddings.get(turn_id)
+    if embeddings is None:
+        embeddings = _turn_embeddings[turn_id] = TurnEmbeddings()
+        while len(_turn_embeddings) > maximum:
+            _turn_embeddings.popitem(last=False)
+    return embeddings
+
+
+def top_k_indices(
+    scores: np.ndarray, k: int, threshold: Optional[float] = None
+) -> List[int]:
+    """Indices of the k highest scores in descending order, via argpartition so we never sort the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return []
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    order = candidates[np.argsort(-scores[candidates])]
+    return [int(i) for i in order if threshold is None or scores[i] >= threshold]
+
+
+class LabelIndex:
+    """
+    A fixed set of labels for zero-shot classification, held as one contiguous (labels, dimensions) matrix of normalised embeddings. The matrix is built the first time it's needed and then reused, so classifying a message costs one query embedding plus a matrix-vector product.
+
+    If you add labels, the matrix is rebuilt lazily on the next call (and the labels that were already there come straight out of the cache).
+    """
+
+    def __init__(self, labels: Sequence[str], model: Optional[str] = None) -> None:
+        self.labels: List[str] = list(labels)
+        self.model = model
+        self.matrix: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def add(self, label: str) -> None:
+        self.labels.append(label)
+        self.matrix = None
+
+    async def build(self) -> np.ndarray:
+        if self.matrix is None or len(self.matrix) != len(self.labels):
+            matrix = await get_embedding_cache().embed(self.labels, model=self.model)
+            self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        return self.matrix
+
+    async def scores(self, query_vector: np.ndarray) -> np.ndarray:
+        return (await self.build()) @ query_vector
+
+    async def classify_vector(
+        self, query_vector: np.ndarray, k: int = 1, threshold: Optional[float] = None
+    ) -> List[str]:
+        if not self.labels:
+            return []
+        scores = await self.scores(query_vector)
+        return [self.labels[i] for i in top_k_indices(scores, k, threshold)]
+
+    async def classify(
+        self,
+        query: str,
+        k: int = 1,
+        threshold: Optional[float] = None,
+        embeddings: Optional[TurnEmbeddings] = None,
+    ) -> List[str]:
+        if not self.labels:
+            return []
+        vector = await query_vector(query, model=self.model, embeddings=embeddings)
+        return await self.classify_vector(vector, k=k, threshold=threshold)
+
+
+async def rank_texts(
+    texts: Sequence[str],
+    query: str,
+    top_k: int = 1,
+    model: Optional[str] = None,
+    threshold: Optional[float] = None,
+    embeddings: Optional[TurnEmbeddings] = None,
+) -> List[str]:
+    """
+    A drop-in for Ranker.rank that goes through the shared cache, so only the query gets embedded on a warm cache. Returns the top_k texts in descending order of cosine similarity, leaving out anything below the threshold if one is given.
+    """
+    if not texts:
+        return []
+    cache = get_embedding_cache()
+    matrix = await cache.embed(texts, model=model)
+    vector = await query_vector(query, model=model, embeddings=embeddings)
+    return [texts[i] for i in top_k_indices(matrix @ vector, top_k, threshold)]
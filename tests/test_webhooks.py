@@ -0,0 +1,65 @@
+import asyncio
+
+import aiohttp
+import discord
+
+from personate.face.face import Face
+
+
+class FakeHTTP:
+    token = "bot-token"
+
+    def __init__(self) -> None:
+        self._HTTPClient__session = discord.utils.MISSING
+
+
+class FakeChannel(discord.TextChannel):
+    def __init__(self, bot: "FakeBot") -> None:
+        self.id = 1
+        self.bot = bot
+        self.lookups = 0
+
+    async def webhooks(self):
+        self.lookups += 1
+        return [
+            discord.Webhook.partial(
+                10, "webhook-token", session=self.bot.http._HTTPClient__session
+            )
+        ]
+
+
+class FakeBot:
+    user = None
+
+    def __init__(self) -> None:
+        self.http = FakeHTTP()
+        self.channel = FakeChannel(self)
+
+    def get_channel(self, channel_id: int):
+        return self.channel
+
+
+def test_cached_webhook_survives_a_new_event_loop(monkeypatch):
+    async def send(webhook, **kwargs):
+        if webhook.session.closed:
+            raise RuntimeError("Event loop is closed")
+        return webhook.session
+
+    monkeypatch.setattr(discord.Webhook, "send", send)
+    bot = FakeBot()
+    face = Face(bot, "https://example.com/avatar.png", "Ziggy")
+
+    async def login_and_send():
+        # Like discord.Bot.start: a fresh session for every login, closed when it stops.
+        session = bot.http._HTTPClient__session = aiohttp.ClientSession()
+        try:
+            return session, await face.send(bot.channel, "hello")
+        finally:
+            await session.close()
+
+    first_session, sent_with = asyncio.run(login_and_send())
+    assert sent_with is first_session
+    second_session, sent_with = asyncio.run(login_and_send())
+    assert sent_with is second_session
+    # The second login rebuilt the webhook from its id and token instead of listing them again.
+    assert bot.channel.lookups == 1